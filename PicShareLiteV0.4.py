@@ -7,12 +7,22 @@ import socket
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
 import shutil
+import sys
+import argparse
 import urllib.parse
 import re
+import stat
+import json
+import hashlib
+import mimetypes
+import urllib.request
+from io import BytesIO
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from flask import Flask, send_file, render_template_string, request, abort, url_for, jsonify
+from flask import Flask, send_file, render_template_string, request, abort, jsonify, g
 from PIL import Image
 # ====== 0. 全局变量 & 配置 (不变) ======
 gui_app = None
@@ -21,7 +31,11 @@ gui_app = None
 class ServerState:
     def __init__(self):
         self.base_dir = r"F:\共享照片"
+        # [新增] 额外的照片根目录 (例如每块硬盘一个)，相册按 base_dir -> extra_roots 的顺序查找
+        self.extra_roots = []
         self.preview_subdir = "._preview_ipv6_opt"
+        # [新增] 预览缓存目录，可单独放到本地 NVMe；留空则使用 base_dir / preview_subdir
+        self.preview_dir = ""
         self.marked_subdir = "被标记的照片"
 
         # [修改] 提高分辨率到 640x640
@@ -39,6 +53,80 @@ class ServerState:
                                       '.jpg', '.jpeg', '.png', '.bmp', '.webp', '.gif', '.heic'
                                   } | self.raw_extensions  # 合并集合
 
+        # [新增] 预览生成失败的退避策略 (秒)：第 n 次失败后等待 base * 2^(n-1)，最长 max
+        self.failure_backoff_base = 60
+        self.failure_backoff_max = 6 * 3600
+
+        # [新增] 解码内存预算 (MB)：所有同时进行的解码任务按文件头估算的内存占用之和不超过该值
+        self.decode_budget_mb = 1536
+        # 单个任务估算超过此值时，能缩小解码的格式 (JPEG) 直接走缩小解码
+        self.decode_job_max_mb = 256
+        # 交给 ImageMagick 的任务按此值占用预算，并通过 -limit 限制 magick 自身内存
+        self.magick_memory_mb = 512
+
+        # [新增] 后台预热自适应限流：前台 (预览/原图) 请求 p90 延迟目标 (毫秒)
+        self.warmup_latency_target_ms = 400
+        self.warmup_max_workers = 8
+        self.warmup_min_workers = 1
+        # 前台请求并发数超过该值视为排队，同样触发降速
+        self.warmup_max_foreground_queue = 4
+        # 前台空闲超过该秒数后，预热全速运行 (不限并发和读盘速率)
+        self.warmup_idle_seconds = 2.0
+        # 前台繁忙时预热读盘速率的起始值和下限 (MB/s)
+        self.warmup_io_mbps = 40
+        self.warmup_io_mbps_floor = 2
+
+        # [新增] 原图下载流量整形：每个客户端 / 全局同时下载原图的上限
+        self.original_max_per_client = 2
+        self.original_max_total = 6
+        # 名额已满时最多排队等待的秒数，超时返回 429
+        self.original_wait_seconds = 30
+        # 每个客户端 / 全局原图带宽上限 (KB/s)，0 表示不限
+        self.original_client_kbps = 0
+        self.original_total_kbps = 0
+        # 有预览图请求正在进行时，原图总带宽临时压到该值 (KB/s)，让预览优先
+        self.original_kbps_under_preview = 2048
+
+        # [新增] 相册照片数超过该值时使用虚拟滚动网格 (只保留可见行的 DOM)，?grid=virtual / full 可强制指定
+        self.virtual_grid_threshold = 1000
+
+        # [新增] 渐进式预览：缓存未命中时先返回内嵌缩略图 / 低分辨率快速解码 (边长像素)，完整预览在后台生成
+        self.progressive_previews = True
+        self.quick_preview_size = 320
+
+        # [新增] 查看器预取：沿翻页方向预取的张数，以及反方向保留的张数 (浏览器预加载 + 服务端预热)
+        self.prefetch_ahead = 3
+        self.prefetch_behind = 1
+
+        # [新增] 文件传输卸载给前端代理：'' 不启用 / 'nginx' (X-Accel-Redirect) / 'sendfile' (Apache、lighttpd 的 X-Sendfile)
+        # 只有来自可信代理 (trusted_proxies) 且带 X-PicShare-Offload 请求头的请求才会卸载，直接访问 Flask 端口的请求照常由 Python 发送
+        self.offload_mode = ""
+        self.offload_prefix = "/_psl_internal"
+        # 前端代理对外监听的端口 (界面上显示的访问地址使用该端口)，0 表示与 port 相同
+        self.public_port = 0
+        # 可信的前端代理地址：只有来自这些地址的请求才会卸载、才读取代理传来的客户端地址 (X-Real-IP)
+        self.trusted_proxies = {'127.0.0.1', '::1', '::ffff:127.0.0.1'}
+
+        # [新增] 路径解析缓存：根目录规范路径与 相册名 -> 目录 的映射，命中时每次只需一次 stat 校验
+        self.path_cache = True
+        # 相册映射的最长有效期 (秒)，到期后重新按根目录顺序查找 (前面的根目录新建了同名相册时会生效)
+        self.path_cache_ttl = 30
+
+
+    @property
+    def roots(self) -> list:
+        """所有照片根目录 (主根目录在前，去重)"""
+        roots = []
+        for r in [self.base_dir] + list(self.extra_roots):
+            if r and r not in roots:
+                roots.append(r)
+        return roots
+
+    def preview_root(self) -> Path:
+        if self.preview_dir:
+            return Path(self.preview_dir)
+        return Path(self.base_dir) / self.preview_subdir
+
 
 state = ServerState()
 
@@ -52,10 +140,150 @@ def update_global_status(message):
 
 
 # ====== 1. 核心逻辑工具 (不变) ======
-def safe_join(base_path: str, *paths: str) -> Path:
+class PathResolver:
+    """
+    [新增] 路径解析缓存。
+    缓存根目录 / 缓存目录的规范路径 (resolve 在 Windows 共享和 NAS 上每次都是多次系统调用)，
+    以及校验过的 相册名 -> (根目录, 相册目录)。根目录配置变化时整体失效；
+    相册命中时用一次 stat 比对目录身份 (设备号 + inode)，相册被改名、删除或替换后自动重新解析。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bases = {}
+        self.albums = {}
+        self.config = None
+        self.hits = 0
+        self.misses = 0
+
+    def _check_config(self):
+        config = (state.base_dir, tuple(state.extra_roots), state.preview_dir,
+                  state.preview_subdir, state.marked_subdir)
+        if config != self.config:
+            with self.lock:
+                self.bases.clear()
+                self.albums.clear()
+                self.config = config
+
+    def clear(self):
+        with self.lock:
+            self.bases.clear()
+            self.albums.clear()
+
+    def canonical(self, path) -> Path:
+        """目录的规范路径 (resolve 结果)"""
+        if not state.path_cache:
+            return Path(path).resolve()
+        self._check_config()
+        key = str(path)
+        result = self.bases.get(key)
+        if result is None:
+            result = Path(key).resolve()
+            with self.lock:
+                if len(self.bases) < 4096:
+                    self.bases[key] = result
+        return result
+
+    @staticmethod
+    def join(base: Path, paths) -> Path | None:
+        """
+        快速拼接 (paths 已解码)：只含普通文件名、且沿途没有符号链接 / 联接点时，
+        拼接结果就是规范路径，每级只需一次 lstat。遇到 ..、盘符、反斜杠、链接等情况返回 None，由调用方走完整的 resolve 检查。
+        只用于相册内的文件名；相册目录本身总是完整 resolve (结果有缓存)。
+        """
+        names = []
+        for part in paths:
+            if '\\' in part or ':' in part:
+                return None
+            for name in part.split('/'):
+                if name in ('', '.', '..'):
+                    return None
+                # Windows 上 "名字." / "名字 " / 8.3 短文件名 (含 ~) 都能指向同一个文件，交给 resolve 得到规范名
+                if os.name == 'nt' and (name.endswith(('.', ' ')) or '~' in name):
+                    return None
+                names.append(name)
+        path = str(base)
+        for name in names:
+            path = os.path.join(path, name)
+            try:
+                st = os.lstat(path)
+            except FileNotFoundError:
+                # 与 resolve(strict=False) 一致：不存在的部分按字面拼接
+                return Path(base, *names)
+            except OSError:
+                return None
+            if stat.S_ISLNK(st.st_mode) or getattr(st, 'st_file_attributes', 0) & 0x400:  # 0x400: 重解析点
+                return None
+        return Path(path)
+
+    @staticmethod
+    def lookup(album: str):
+        """不经缓存按根目录顺序查找相册，返回 (根目录配置值, 根目录, 相册目录) 或 (None, None, None)"""
+        for root in state.roots:
+            # 相册目录必须用规范路径 (大小写、结尾的点 / 空格、短文件名都已还原) 做系统文件夹检查
+            path = safe_join(root, album, fast=False)
+            if not path or not path.is_dir():
+                continue
+            root_path = resolver.canonical(root)
+            if path == root_path or is_system_path(root_path, path):
+                return None, None, None
+            return root, root_path, path
+        return None, None, None
+
+    def album(self, album: str):
+        if not state.path_cache:
+            return self.lookup(album)[1:]
+        self._check_config()
+        hit = self.albums.get(album)
+        if hit:
+            joined, ident, result, expires = hit
+            if time.monotonic() < expires:
+                try:
+                    st = os.stat(joined)
+                    if (st.st_dev, st.st_ino) == ident:
+                        with self.lock:
+                            self.hits += 1
+                        return result
+                except OSError:
+                    pass
+            with self.lock:
+                self.albums.pop(album, None)
+
+        with self.lock:
+            self.misses += 1
+        root, root_path, path = self.lookup(album)
+        # 不存在的相册不缓存，新建的相册立即可见
+        if path is not None:
+            try:
+                st = os.stat(path)
+            except OSError:
+                return root_path, path
+            if st.st_ino:
+                joined = os.path.join(root, urllib.parse.unquote(album))
+                entry = (joined, (st.st_dev, st.st_ino), (root_path, path), time.monotonic() + state.path_cache_ttl)
+                with self.lock:
+                    if len(self.albums) >= 4096:
+                        self.albums.clear()
+                    self.albums[album] = entry
+        return root_path, path
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {'albums': len(self.albums), 'bases': len(self.bases), 'hits': self.hits, 'misses': self.misses}
+
+
+resolver = PathResolver()
+
+
+def safe_join(base_path: str, *paths: str, fast: bool = True) -> Path:
     try:
-        base = Path(base_path).resolve()
+        # [修改] 根目录的规范路径走缓存；fast 时普通文件名直接拼接 (沿途无链接时结果与 resolve 相同)
+        base = resolver.canonical(base_path)
         decoded_paths = [urllib.parse.unquote(p) for p in paths]
+        if fast and state.path_cache:
+            fast = resolver.join(base, decoded_paths)
+            if fast is not None:
+                return fast
         final_path = base.joinpath(*decoded_paths).resolve()
         if base in final_path.parents or base == final_path:
             return final_path
@@ -64,11 +292,817 @@ def safe_join(base_path: str, *paths: str) -> Path:
         return None
 
 
+def is_system_path(root: Path, path: Path) -> bool:
+    """[新增] 路径是否落在根目录下的标记 / 预览文件夹，或 (单独配置的) 预览缓存目录里"""
+    try:
+        rel = path.relative_to(root)
+        # Windows 上文件夹名不区分大小写
+        if rel.parts and os.path.normcase(rel.parts[0]) in (os.path.normcase(state.marked_subdir),
+                                                            os.path.normcase(state.preview_subdir)):
+            return True
+    except ValueError:
+        pass
+    cache = resolver.canonical(state.preview_root())
+    return path == cache or cache in path.parents
+
+
+def resolve_album(album: str):
+    """
+    [新增] 在所有照片根目录中按顺序查找相册，返回 (根目录, 相册目录)，都是 resolve 后的 Path。
+    找不到或指向系统文件夹时返回 (None, None)。结果经 resolver 缓存。
+    """
+    return resolver.album(album)
+
+
+class FailureRegistry:
+    """
+    预览生成失败记录 (负缓存)。
+    按源文件路径记录失败次数、原因和下次允许重试的时间；源文件 mtime 变化后记录自动失效。
+    记录持久化到预览缓存目录下的 ._failures.json，重启程序后依然有效。
+    改动只标记为待写入，由定时器合并后在锁外写盘，大批文件连续失败时不会反复重写整个文件。
+    """
+
+    FILE_NAME = "._failures.json"
+    FLUSH_DELAY = 1.0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # 保证多次写盘按顺序进行，旧快照不会覆盖新快照
+        self.write_lock = threading.Lock()
+        self.records = {}
+        self.loaded_from = None
+        self.dirty = False
+        self.timer = None
+
+    @staticmethod
+    def _file() -> Path:
+        return state.preview_root() / FailureRegistry.FILE_NAME
+
+    def _ensure_loaded(self):
+        # 根目录切换后重新加载对应缓存目录下的记录
+        path = self._file()
+        if self.loaded_from == path:
+            return
+        if self.dirty:
+            # 切换前把旧目录下尚未写盘的记录写掉 (很少发生，直接在锁内写)
+            self._write(self.loaded_from, dict(self.records))
+            self.dirty = False
+        self.loaded_from = path
+        self.records = {}
+        try:
+            self.records = json.loads(path.read_text(encoding='utf-8'))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"⚠️ 失败记录读取出错，已忽略: {e}")
+
+    def _save(self):
+        """标记待写入 (调用方持有 self.lock)，FLUSH_DELAY 秒后统一写盘"""
+        self.dirty = True
+        if self.timer is None:
+            self.timer = threading.Timer(self.FLUSH_DELAY, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    @staticmethod
+    def _write(path: Path, records: dict):
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix('.tmp')
+            tmp.write_text(json.dumps(records, ensure_ascii=False), encoding='utf-8')
+            os.replace(tmp, path)
+        except Exception as e:
+            logger.warning(f"⚠️ 失败记录保存出错: {e}")
+
+    def flush(self):
+        with self.write_lock:
+            with self.lock:
+                self.timer = None
+                if not self.dirty:
+                    return
+                self.dirty = False
+                # 记录只会被整条替换，浅拷贝即可在锁外安全序列化
+                path, records = self.loaded_from, dict(self.records)
+            self._write(path, records)
+
+    def should_skip(self, original_path: Path) -> bool:
+        """源文件仍处于退避期内则返回 True"""
+        key = str(original_path)
+        with self.lock:
+            self._ensure_loaded()
+            rec = self.records.get(key)
+            if not rec:
+                return False
+            try:
+                mtime = original_path.stat().st_mtime
+            except OSError:
+                return False
+            if rec['mtime'] != mtime:
+                # 文件已被替换或重新导出，允许立即重试
+                del self.records[key]
+                self._save()
+                return False
+            return time.time() < rec['next_retry']
+
+    def record_failure(self, original_path: Path, reason: str):
+        key = str(original_path)
+        try:
+            mtime = original_path.stat().st_mtime
+        except OSError:
+            return
+        with self.lock:
+            self._ensure_loaded()
+            rec = self.records.get(key)
+            count = rec['count'] + 1 if rec and rec['mtime'] == mtime else 1
+            delay = min(state.failure_backoff_base * 2 ** (count - 1), state.failure_backoff_max)
+            now = time.time()
+            self.records[key] = {
+                'mtime': mtime,
+                'count': count,
+                'reason': reason,
+                'last_failed': now,
+                'next_retry': now + delay,
+            }
+            self._save()
+        logger.warning(f"🚫 预览失败第 {count} 次，{int(delay)} 秒内不再重试: {original_path.name}")
+
+    def clear(self, original_path: Path):
+        key = str(original_path)
+        with self.lock:
+            self._ensure_loaded()
+            if self.records.pop(key, None) is not None:
+                self._save()
+
+    def clear_all(self):
+        with self.lock:
+            self._ensure_loaded()
+            self.records = {}
+            self._save()
+
+    def snapshot(self) -> list:
+        """返回 [(路径, 记录), ...]，最近失败的在前"""
+        with self.lock:
+            self._ensure_loaded()
+            items = [(k, dict(v)) for k, v in self.records.items()]
+        items.sort(key=lambda kv: kv[1]['last_failed'], reverse=True)
+        return items
+
+
+failures = FailureRegistry()
+
+
+def make_placeholder_jpeg() -> bytes:
+    """生成一张很小的占位图 (深灰底 + 破图标记)，用于预览生成失败的文件"""
+    from PIL import ImageDraw
+
+    img = Image.new('RGB', (160, 160), (44, 44, 46))
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((50, 50, 110, 110), outline=(110, 110, 115), width=3)
+    draw.line((50, 50, 110, 110), fill=(110, 110, 115), width=3)
+    buf = BytesIO()
+    img.save(buf, "JPEG", quality=70)
+    return buf.getvalue()
+
+
+PLACEHOLDER_JPEG = make_placeholder_jpeg()
+
+
+class DecodeBudget:
+    """
+    解码内存预算 (像素预算)。
+    每个解码任务在真正解码前，先根据文件头里的尺寸和色彩模式估算内存占用，再向预算申请；
+    预算不够时按先来后到排队。单个任务最多占满整个预算 (即独占执行)，不会永远等不到。
+    """
+
+    # 各色彩模式每像素字节数
+    BYTES_PER_PIXEL = {
+        '1': 1, 'L': 1, 'P': 1, 'LA': 2, 'PA': 2, 'I;16': 2, 'I;16B': 2, 'I;16L': 2,
+        'RGB': 3, 'YCbCr': 3, 'LAB': 3, 'HSV': 3, 'RGBA': 4, 'RGBX': 4, 'CMYK': 4, 'I': 4, 'F': 4,
+    }
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.queue = deque()
+        self.used = 0
+        self.active = 0
+        self.peak = 0
+        self.reduced = 0
+
+    @property
+    def capacity(self) -> int:
+        return state.decode_budget_mb * 1024 * 1024
+
+    @classmethod
+    def estimate(cls, size, mode) -> int:
+        """解码后的位图 + 一份处理用副本 (色彩转换 / 缩放)"""
+        width, height = size
+        return width * height * cls.BYTES_PER_PIXEL.get(mode, 4) * 2
+
+    def acquire(self, cost: int) -> int:
+        cost = min(cost, self.capacity)
+        ticket = object()
+        with self.cond:
+            self.queue.append(ticket)
+            while self.queue[0] is not ticket or (self.used > 0 and self.used + cost > self.capacity):
+                self.cond.wait()
+            self.queue.popleft()
+            self.used += cost
+            self.active += 1
+            self.peak = max(self.peak, self.used)
+            self.cond.notify_all()
+        return cost
+
+    def release(self, cost: int):
+        with self.cond:
+            self.used -= cost
+            self.active -= 1
+            self.cond.notify_all()
+
+    @contextmanager
+    def reserve(self, cost: int):
+        granted = self.acquire(cost)
+        try:
+            yield
+        finally:
+            self.release(granted)
+
+    def snapshot(self) -> dict:
+        with self.cond:
+            return {
+                'used_mb': self.used / 1024 / 1024,
+                'capacity_mb': self.capacity / 1024 / 1024,
+                'peak_mb': self.peak / 1024 / 1024,
+                'active': self.active,
+                'waiting': len(self.queue),
+                'reduced': self.reduced,
+            }
+
+
+decode_budget = DecodeBudget()
+
+
+class WarmupThrottle:
+    """
+    后台预热自适应限流器。
+    记录前台请求 (预览 / 原图) 的延迟和并发数，每秒调整一次后台预热的并发名额和读盘速率：
+    前台延迟超标或排队时名额和速率减半；前台正常但繁忙时逐步加一；前台空闲时全速运行。
+    """
+
+    WINDOW_SECONDS = 5.0
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.limit = state.warmup_max_workers
+        self.active = 0
+        self.fg_inflight = 0
+        self.last_fg = 0.0
+        self.samples = deque()  # (完成时间, 延迟秒)
+        self.p90_ms = 0.0
+        self.io_rate = 0  # 字节/秒，0 表示不限速
+        self.io_next = 0.0
+        self.controller = None
+
+    def ensure_started(self):
+        with self.cond:
+            if self.controller is None:
+                self.controller = threading.Thread(target=self._control_loop, daemon=True)
+                self.controller.start()
+
+    # ---- 前台请求统计 ----
+    def foreground_started(self):
+        with self.cond:
+            self.fg_inflight += 1
+            self.last_fg = time.time()
+
+    def foreground_finished(self, latency: float):
+        with self.cond:
+            self.fg_inflight -= 1
+            self.last_fg = time.time()
+            self.samples.append((self.last_fg, latency))
+
+    # ---- 后台任务闸门 ----
+    @contextmanager
+    def background_slot(self):
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.active -= 1
+                self.cond.notify_all()
+
+    def consume_io(self, nbytes: int):
+        """按当前速率为后台读盘排队 (简单的时间片令牌桶)"""
+        with self.cond:
+            if not self.io_rate:
+                return
+            now = time.time()
+            start = max(now, self.io_next)
+            self.io_next = start + nbytes / self.io_rate
+        if start > now:
+            time.sleep(start - now)
+
+    # ---- 控制回路 ----
+    def _control_loop(self):
+        while True:
+            time.sleep(1.0)
+            try:
+                self.adjust()
+            except Exception:
+                logger.exception("预热限流调整出错")
+
+    def adjust(self):
+        now = time.time()
+        with self.cond:
+            while self.samples and now - self.samples[0][0] > self.WINDOW_SECONDS:
+                self.samples.popleft()
+            latencies = sorted(lat for _, lat in self.samples)
+            self.p90_ms = latencies[int(len(latencies) * 0.9)] * 1000 if latencies else 0.0
+
+            floor_rate = state.warmup_io_mbps_floor * 1024 * 1024
+            if self.fg_inflight == 0 and now - self.last_fg > state.warmup_idle_seconds:
+                # 前台空闲：全速预热
+                self.limit = state.warmup_max_workers
+                self.io_rate = 0
+            elif self.p90_ms > state.warmup_latency_target_ms or \
+                    self.fg_inflight > state.warmup_max_foreground_queue:
+                # 前台延迟超标或排队：乘性减少
+                self.limit = max(state.warmup_min_workers, self.limit // 2)
+                start_rate = state.warmup_io_mbps * 1024 * 1024
+                self.io_rate = max(floor_rate, (self.io_rate or start_rate) // 2)
+            else:
+                # 前台繁忙但延迟达标：加性增加
+                self.limit = min(state.warmup_max_workers, self.limit + 1)
+                if self.io_rate:
+                    self.io_rate = int(self.io_rate * 1.25)
+            self.cond.notify_all()
+
+    def snapshot(self) -> dict:
+        with self.cond:
+            return {
+                'limit': self.limit,
+                'active': self.active,
+                'fg_inflight': self.fg_inflight,
+                'p90_ms': self.p90_ms,
+                'io_mbps': self.io_rate / 1024 / 1024,
+            }
+
+
+warmup_throttle = WarmupThrottle()
+
+
+class Pacer:
+    """按速率排队发送：返回本次发送 nbytes 前需要等待的秒数 (rate 为 0 表示不限速)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.next_free = 0.0
+
+    def reserve(self, nbytes: int, rate: float) -> float:
+        if not rate:
+            return 0.0
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_free)
+            self.next_free = start + nbytes / rate
+        return start - now
+
+
+class TrafficShaper:
+    """
+    原图下载流量整形。
+    限制每个客户端和全局同时进行的原图传输数量，按客户端 / 全局带宽逐块限速；
+    有预览图正在发送时，原图总带宽临时降到 original_kbps_under_preview，保证大家的预览先加载出来
+    (按响应体实际发送的时间计，等待生成的请求不算)。
+    """
+
+    PREVIEW_GRACE_SECONDS = 0.5
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.per_client = {}
+        self.transfers = {}
+        self.next_id = 0
+        self.global_pacer = Pacer()
+        self.client_pacers = {}
+        self.preview_inflight = 0
+        self.last_preview = 0.0
+
+    # ---- 预览优先 ----
+    def preview_started(self):
+        with self.cond:
+            self.preview_inflight += 1
+
+    def preview_finished(self):
+        with self.cond:
+            self.preview_inflight -= 1
+            self.last_preview = time.time()
+
+    def previews_busy(self) -> bool:
+        return self.preview_inflight > 0 or time.time() - self.last_preview < self.PREVIEW_GRACE_SECONDS
+
+    def wrap_preview(self, response):
+        """预览响应体开始发送时计入 preview_inflight，发送结束 (或客户端断开) 时移出"""
+        response.response = PreviewStream(response.response, self)
+        return response
+
+    # ---- 传输名额 ----
+    def acquire(self, client: str, name: str, size: int):
+        """申请一个原图传输名额，超时返回 None"""
+        deadline = time.time() + state.original_wait_seconds
+        with self.cond:
+            while self.per_client.get(client, 0) >= state.original_max_per_client or \
+                    len(self.transfers) >= state.original_max_total:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+            self.next_id += 1
+            tid = self.next_id
+            self.per_client[client] = self.per_client.get(client, 0) + 1
+            self.client_pacers.setdefault(client, Pacer())
+            self.transfers[tid] = {'client': client, 'name': name, 'size': size, 'sent': 0, 'started': time.time()}
+            return tid
+
+    def release(self, tid: int):
+        with self.cond:
+            info = self.transfers.pop(tid, None)
+            if info is None:
+                return
+            client = info['client']
+            self.per_client[client] -= 1
+            if not self.per_client[client]:
+                del self.per_client[client]
+                self.client_pacers.pop(client, None)
+            self.cond.notify_all()
+
+    def pace(self, tid: int, nbytes: int):
+        with self.cond:
+            info = self.transfers.get(tid)
+            if info is None:
+                return
+            info['sent'] += nbytes
+            client_pacer = self.client_pacers[info['client']]
+        total_rate = state.original_total_kbps * 1024
+        if self.previews_busy():
+            limit = state.original_kbps_under_preview * 1024
+            total_rate = min(total_rate, limit) if total_rate else limit
+        delay = max(client_pacer.reserve(nbytes, state.original_client_kbps * 1024),
+                    self.global_pacer.reserve(nbytes, total_rate))
+        if delay > 0:
+            time.sleep(delay)
+
+    def wrap(self, response, tid: int):
+        """用限速迭代器包住 send_file 的响应体 (Range / 304 等由 send_file 处理好后再包)"""
+        response.response = ShapedStream(response.response, self, tid)
+        return response
+
+    def snapshot(self) -> list:
+        now = time.time()
+        with self.cond:
+            items = [dict(v) for v in self.transfers.values()]
+        for item in items:
+            item['rate_kbps'] = item['sent'] / 1024 / max(now - item['started'], 0.001)
+        items.sort(key=lambda x: x['started'])
+        return items
+
+
+class ShapedStream:
+    """逐块限速的响应体；close() 时归还传输名额 (客户端中途断开也会调用)"""
+
+    def __init__(self, inner, shaper: TrafficShaper, tid: int):
+        self.inner = inner
+        self.shaper = shaper
+        self.tid = tid
+
+    def __iter__(self):
+        for chunk in self.inner:
+            self.shaper.pace(self.tid, len(chunk))
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.inner, 'close'):
+                self.inner.close()
+        finally:
+            self.shaper.release(self.tid)
+
+
+class PreviewStream:
+    """[新增] 预览响应体：只在真正发送字节期间算作「有预览在传」"""
+
+    def __init__(self, inner, shaper: TrafficShaper):
+        self.inner = inner
+        self.shaper = shaper
+        self.sending = False
+
+    def __iter__(self):
+        for chunk in self.inner:
+            if not self.sending:
+                self.sending = True
+                self.shaper.preview_started()
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.inner, 'close'):
+                self.inner.close()
+        finally:
+            if self.sending:
+                self.sending = False
+                self.shaper.preview_finished()
+
+
+traffic_shaper = TrafficShaper()
+
+
+def split_source(original_path: Path):
+    """[新增] 把原图路径拆成 (所属相册文件夹名, 相对该相册文件夹的 posix 路径)，不在任何根目录下返回 (None, None)"""
+    for root in state.roots:
+        try:
+            rel = original_path.relative_to(resolver.canonical(root))
+        except ValueError:
+            continue
+        if len(rel.parts) >= 2:
+            return rel.parts[0], Path(*rel.parts[1:]).as_posix()
+    return None, None
+
+
+class MetadataIndex:
+    """
+    按相册保存的 EXIF 元数据索引 (拍摄时间、方向、尺寸、机身、镜头)。
+    在生成预览时顺带读取 (只读文件头)，持久化到 预览缓存目录/._meta/<相册>.json，
+    相册页面排序和筛选只查内存中的索引，不再逐个打开文件。
+    """
+
+    DIR_NAME = "._meta"
+    FLUSH_DELAY = 3.0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.albums = {}  # 索引文件路径 -> {相对路径: 元数据}
+        self.dirty = set()
+        self.timer = None
+
+    @staticmethod
+    def _file(album: str) -> Path:
+        return state.preview_root() / MetadataIndex.DIR_NAME / f"{album}.json"
+
+    def _load(self, path: Path) -> dict:
+        entries = self.albums.get(path)
+        if entries is None:
+            try:
+                entries = json.loads(path.read_text(encoding='utf-8'))
+            except FileNotFoundError:
+                entries = {}
+            except Exception as e:
+                logger.warning(f"⚠️ 元数据索引读取出错，将重新建立: {path.name} - {e}")
+                entries = {}
+            self.albums[path] = entries
+        return entries
+
+    def album(self, album: str) -> dict:
+        """返回相册索引的快照 {相对相册文件夹的路径: 元数据}"""
+        with self.lock:
+            return dict(self._load(self._file(album)))
+
+    def has(self, original_path: Path, mtime: float) -> bool:
+        album, rel = split_source(original_path)
+        if not album:
+            return True
+        with self.lock:
+            entry = self._load(self._file(album)).get(rel)
+        return bool(entry) and entry['mtime'] == mtime
+
+    @staticmethod
+    def read(im: Image.Image, original_path: Path) -> dict:
+        """从已打开 (尚未解码) 的图片读取元数据"""
+        mtime = original_path.stat().st_mtime
+        meta = {
+            'mtime': mtime,
+            'taken': None,
+            'orientation': 1,
+            'width': 0,
+            'height': 0,
+            'camera': "",
+            'lens': "",
+            'raw': original_path.suffix.lower() in state.raw_extensions,
+        }
+        if im is not None:
+            meta['width'], meta['height'] = im.size
+            # 各字段分别解析，某一项格式不对 (例如相机时钟未设置时的 "0000:00:00 00:00:00") 不影响其他字段
+            try:
+                exif = im.getexif()
+                ifd = exif.get_ifd(0x8769)  # Exif 子 IFD
+            except Exception:
+                exif = ifd = None
+            if exif is not None:
+                try:
+                    meta['orientation'] = int(exif.get(274, 1))
+                except Exception:
+                    pass
+                try:
+                    make = str(exif.get(271) or "").strip('\x00 ')
+                    model = str(exif.get(272) or "").strip('\x00 ')
+                    meta['camera'] = model if model.startswith(make) else f"{make} {model}".strip()
+                    meta['lens'] = str(ifd.get(42036) or "").strip('\x00 ')
+                except Exception:
+                    pass
+                try:
+                    taken = ifd.get(36867) or ifd.get(36868) or exif.get(306)  # DateTimeOriginal / Digitized / DateTime
+                    if taken:
+                        taken = str(taken).strip('\x00 ')
+                        time.strptime(taken, '%Y:%m:%d %H:%M:%S')
+                        meta['taken'] = taken.replace(':', '-', 2)
+                except Exception:
+                    pass
+            if meta['orientation'] in (5, 6, 7, 8):
+                meta['width'], meta['height'] = meta['height'], meta['width']
+        if not meta['taken']:
+            # 没有 EXIF 拍摄时间时用文件修改时间排序
+            meta['taken'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(mtime))
+            meta['taken_from_mtime'] = True
+        return meta
+
+    def update(self, original_path: Path, meta: dict):
+        album, rel = split_source(original_path)
+        if not album:
+            return
+        with self.lock:
+            path = self._file(album)
+            self._load(path)[rel] = meta
+            self.dirty.add(path)
+            if self.timer is None:
+                # 攒一批再写盘，避免预热时每张图都重写一次 JSON
+                self.timer = threading.Timer(self.FLUSH_DELAY, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def index_file(self, original_path: Path, im: Image.Image = None):
+        """读取并记录一个文件的元数据；im 为 None 时自行打开文件头"""
+        try:
+            if im is not None:
+                self.update(original_path, self.read(im, original_path))
+                return
+            try:
+                with Image.open(original_path) as opened:
+                    meta = self.read(opened, original_path)
+            except Exception:
+                meta = self.read(None, original_path)  # PIL 打不开的 RAW 至少记录类型和时间
+            self.update(original_path, meta)
+        except Exception as e:
+            logger.warning(f"⚠️ 读取元数据失败: {original_path.name} - {e}")
+
+    def flush(self):
+        with self.lock:
+            self.timer = None
+            pending = [(path, dict(self.albums[path])) for path in self.dirty]
+            self.dirty.clear()
+        for path, entries in pending:
+            try:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                tmp = path.with_suffix('.tmp')
+                tmp.write_text(json.dumps(entries, ensure_ascii=False), encoding='utf-8')
+                os.replace(tmp, path)
+            except Exception as e:
+                logger.warning(f"⚠️ 元数据索引保存出错: {path.name} - {e}")
+
+
+metadata_index = MetadataIndex()
+
+
+class PreviewStore:
+    """
+    按内容指纹去重的预览缓存。
+    预览存放在 预览缓存目录/._blobs/<指纹前两位>/<指纹>.jpg，多个相册里的同一张照片共用一份预览；
+    原图路径 -> 指纹 的引用记录在 ._refs.json，mtime 和大小都没变时直接复用，不再读原图。
+    """
+
+    REFS_NAME = "._refs.json"
+    BLOB_DIR = "._blobs"
+    SAMPLE_SIZE = 64 * 1024
+    FLUSH_DELAY = 3.0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.refs = {}
+        self.loaded_from = None
+        self.timer = None
+        self.write_lock = threading.Lock()
+
+    def _ensure_loaded(self):
+        path = state.preview_root() / self.REFS_NAME
+        if self.loaded_from == path:
+            return
+        self.loaded_from = path
+        self.refs = {}
+        try:
+            self.refs = json.loads(path.read_text(encoding='utf-8'))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"⚠️ 预览引用记录读取出错，将重新建立: {e}")
+
+    @classmethod
+    def fingerprint(cls, path: Path, size: int) -> str:
+        """快速内容指纹：文件大小 + 开头 / 中间 / 结尾各 64KB 的 BLAKE2b"""
+        h = hashlib.blake2b(str(size).encode(), digest_size=16)
+        with open(path, 'rb') as f:
+            if size <= cls.SAMPLE_SIZE * 3:
+                h.update(f.read())
+            else:
+                for offset in (0, size // 2 - cls.SAMPLE_SIZE // 2, size - cls.SAMPLE_SIZE):
+                    f.seek(offset)
+                    h.update(f.read(cls.SAMPLE_SIZE))
+        return h.hexdigest()
+
+    @classmethod
+    def blob_path(cls, fp: str) -> Path:
+        return state.preview_root() / cls.BLOB_DIR / fp[:2] / f"{fp}.jpg"
+
+    def lookup(self, original_path: Path, st: os.stat_result = None) -> Path | None:
+        """只查引用记录 (不读原图)，记录缺失或过期时返回 None"""
+        st = st or original_path.stat()
+        with self.lock:
+            self._ensure_loaded()
+            rec = self.refs.get(str(original_path))
+        if rec and rec['mtime'] == st.st_mtime and rec['size'] == st.st_size:
+            return self.blob_path(rec['fp'])
+        return None
+
+    def path_for(self, original_path: Path) -> Path:
+        """返回原图对应的共享预览路径，必要时计算指纹并迁移旧版按路径存放的预览"""
+        st = original_path.stat()
+        blob = self.lookup(original_path, st)
+        if blob is not None:
+            return blob
+
+        fp = self.fingerprint(original_path, st.st_size)
+        blob = self.blob_path(fp)
+        album, rel = split_source(original_path)
+        if album:
+            legacy = state.preview_root() / album / rel
+            try:
+                if legacy.is_file():
+                    if blob.exists():
+                        legacy.unlink()
+                    else:
+                        blob.parent.mkdir(parents=True, exist_ok=True)
+                        os.replace(legacy, blob)
+            except OSError:
+                pass
+
+        with self.lock:
+            self._ensure_loaded()
+            self.refs[str(original_path)] = {'mtime': st.st_mtime, 'size': st.st_size, 'fp': fp}
+            if self.timer is None:
+                self.timer = threading.Timer(self.FLUSH_DELAY, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        return blob
+
+    def flush(self):
+        # write_lock 保证多次写盘按顺序进行；序列化在 self.lock 之外，不阻塞 lookup
+        with self.write_lock:
+            with self.lock:
+                self.timer = None
+                if self.loaded_from is None:
+                    return
+                # 引用记录只会被整条替换，浅拷贝即可
+                path, refs = self.loaded_from, dict(self.refs)
+            try:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                tmp = path.with_suffix('.tmp')
+                tmp.write_text(json.dumps(refs, ensure_ascii=False), encoding='utf-8')
+                os.replace(tmp, path)
+            except Exception as e:
+                logger.warning(f"⚠️ 预览引用记录保存出错: {e}")
+
+    def stats(self) -> tuple:
+        """(引用的原图数, 实际预览文件数)"""
+        with self.lock:
+            self._ensure_loaded()
+            return len(self.refs), len({rec['fp'] for rec in self.refs.values()})
+
+
+preview_store = PreviewStore()
+
+
 class PreviewGenerator:
     def __init__(self):
         # 线程池用于并发扫描和生成
-        self.executor = ThreadPoolExecutor(max_workers=8)
+        self.executor = ThreadPoolExecutor(max_workers=state.warmup_max_workers)
         self.scanned_files = set()
+        # [修改] 每份预览一把锁 (路径 -> [锁, 引用数])，用完即删
+        self.locks = {}
+        self.locks_guard = threading.Lock()
+        # [新增] 前台触发的后台生成 (渐进式预览等) 使用单独的小线程池，不排在预热任务后面
+        self.urgent_executor = ThreadPoolExecutor(max_workers=2)
+        self.pending = set()
+        self.pending_lock = threading.Lock()
 
     @staticmethod
     def generate_raw_preview_with_magick(original_path: Path, preview_path: Path) -> bool:
@@ -86,8 +1120,11 @@ class PreviewGenerator:
             # -auto-orient : 根据 EXIF 自动旋转图片 (RAW文件常需要这个)
             # -thumbnail   : 生成缩略图
             # -quality     : JPEG 质量
+            # -limit       : 限制 magick 自身内存，超出部分落盘，而不是把整机挤进 swap
             magick_cmd = [
                 command,
+                '-limit', 'memory', f"{state.magick_memory_mb}MiB",
+                '-limit', 'map', f"{state.magick_memory_mb * 2}MiB",
                 str(original_path),
                 '-auto-orient',
                 '-thumbnail', f"{state.thumb_size[0]}x{state.thumb_size[1]}>",
@@ -103,15 +1140,16 @@ class PreviewGenerator:
                 startupinfo = subprocess.STARTUPINFO()
                 startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
 
-            # 3. 执行命令
-            result = subprocess.run(
-                magick_cmd,
-                capture_output=True,
-                text=True,
-                timeout=60,  # 增加超时时间到 60秒
-                check=False,
-                startupinfo=startupinfo  # 应用隐藏窗口设置
-            )
+            # 3. 执行命令 (按 magick 的内存上限占用解码预算)
+            with decode_budget.reserve(state.magick_memory_mb * 1024 * 1024):
+                result = subprocess.run(
+                    magick_cmd,
+                    capture_output=True,
+                    text=True,
+                    timeout=60,  # 增加超时时间到 60秒
+                    check=False,
+                    startupinfo=startupinfo  # 应用隐藏窗口设置
+                )
 
             # 4. 检查结果
             if result.returncode != 0:
@@ -163,97 +1201,262 @@ class PreviewGenerator:
             pass
         return None
 
-    def generate_sync(self, original_path: Path, preview_path: Path):
+    @staticmethod
+    def decode_thumbnail(im: Image.Image) -> Image.Image:
         """
-        同步生成预览图逻辑：
-        1. 检查是否存在 -> 2. PIL 读取 -> 3. 提取内嵌缩略图 -> 4. ImageMagick 转码
+        [新增] 在解码预算内把已打开 (尚未解码) 的图片解码并缩成预览尺寸。
+        估算超过单任务上限的 JPEG 走 draft 缩小解码 (1/2 ~ 1/8)，其余格式排队等待预算。
         """
-        try:
-            from PIL import Image, ImageOps
+        from PIL import ImageOps
+
+        cost = DecodeBudget.estimate(im.size, im.mode)
+        if cost > state.decode_job_max_mb * 1024 * 1024 and im.format == 'JPEG':
+            # draft 保证结果不小于请求尺寸，留 2 倍余量给 LANCZOS 缩放
+            im.draft('RGB', (state.thumb_size[0] * 2, state.thumb_size[1] * 2))
+            cost = DecodeBudget.estimate(im.size, im.mode)
+            with decode_budget.cond:
+                decode_budget.reduced += 1
+
+        with decode_budget.reserve(cost):
+            im.load()
+            img = im if im.mode == "RGB" else im.convert("RGB")
+            img.thumbnail(state.thumb_size, Image.Resampling.LANCZOS)
+        # 先缩小再旋转，避免对全尺寸位图做一次额外拷贝
+        return ImageOps.exif_transpose(img)  # 处理手机照片的旋转
 
-            # 检查文件是否已存在且大小正常
-            if preview_path.exists() and preview_path.stat().st_size > 100:
-                return True
+    def quick_preview(self, original_path: Path) -> bytes | None:
+        """
+        [新增] 渐进式预览的先行版：RAW 取内嵌缩略图，JPEG 用 draft 按 1/2 ~ 1/8 比例快速解码。
+        其他格式没有廉价的办法，返回 None (调用方照常同步生成完整预览)。
+        """
+        from PIL import ImageOps
 
-            preview_path.parent.mkdir(parents=True, exist_ok=True)
-            img = None
+        size = (state.quick_preview_size, state.quick_preview_size)
+        try:
+            if original_path.suffix.lower() in state.raw_extensions:
+                im = self.extract_embedded_thumbnail(original_path)
+                if im is None:
+                    return None
+            else:
+                im = Image.open(original_path)
+                if im.format != 'JPEG':
+                    im.close()
+                    return None
+                im.draft('RGB', size)
+            with im:
+                with decode_budget.reserve(DecodeBudget.estimate(im.size, im.mode)):
+                    im.load()
+                    img = im if im.mode == "RGB" else im.convert("RGB")
+                    img.thumbnail(size)
+                img = ImageOps.exif_transpose(img)
+            buf = BytesIO()
+            img.save(buf, "JPEG", quality=50)
+            return buf.getvalue()
+        except Exception:
+            return None
 
-            # 定义 RAW 扩展名集合
-            raw_exts = {'.cr2', '.cr3', '.nef', '.arw', '.dng', '.orf', '.rw2', '.pef', '.sr2'}
-            is_raw = original_path.suffix.lower() in raw_exts
+    def render_async(self, original_path: Path, preview_path: Path = None):
+        """
+        [新增] 在后台生成完整预览 (不经过预热限流)，同一张原图只排队一次。
+        preview_path 为空时在后台线程里查找 / 计算预览路径 (需要读原图算指纹)。
+        """
+        key = str(original_path)
+        with self.pending_lock:
+            if key in self.pending:
+                return
+            self.pending.add(key)
 
-            # [尝试 1] 直接用 PIL 打开 (适合 JPG, PNG, 部分简单 RAW)
+        def job():
             try:
-                with Image.open(original_path) as im:
-                    im.load()
-                    img = im.copy()
-            except Exception:
-                img = None
-
-            # [尝试 2] 如果是 RAW 且 PIL 失败，尝试提取内嵌预览图
-            if img is None and is_raw:
-                img = self.extract_embedded_thumbnail(original_path)
+                self.generate_sync(original_path, preview_path or preview_store.path_for(original_path))
+            finally:
+                with self.pending_lock:
+                    self.pending.discard(key)
 
-            # [尝试 3] 如果前两者都失败，且是 RAW，调用 ImageMagick
-            if img is None and is_raw:
-                # 注意：Magick 会直接生成文件，不需要后续的 PIL save 操作
-                # 直接返回 Magick 的执行结果
-                return self.generate_raw_preview_with_magick(original_path, preview_path)
+        self.urgent_executor.submit(job)
 
-            # 如果以上方法都无法获取图像对象，则宣告失败
-            if img is None:
-                return False
+    def generate_sync(self, original_path: Path, preview_path: Path):
+        """同步生成预览图，成功 (或已存在) 返回 True"""
+        return self.generate_with_method(original_path, preview_path) is not None
+
+    @contextmanager
+    def lock_for(self, preview_path: Path):
+        """[新增] 同一份 (共享) 预览同时只允许一个线程生成；不相关的预览互不等待"""
+        key = str(preview_path)
+        with self.locks_guard:
+            entry = self.locks.get(key)
+            if entry is None:
+                entry = self.locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.locks_guard:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.locks[key]
+
+    def generate_with_method(self, original_path: Path, preview_path: Path) -> str | None:
+        """
+        同步生成预览图逻辑：
+        1. 检查是否存在 -> 2. PIL 读取 -> 3. 提取内嵌缩略图 -> 4. ImageMagick 转码
+        [修改] 返回实际走的路径 ('cached' / 'pil' / 'embedded' / 'magick')，失败返回 None
+        """
+        try:
+            # 检查文件是否已存在且大小正常
+            if preview_path.exists() and preview_path.stat().st_size > 100:
+                # [新增] 旧缓存补建元数据索引
+                if not metadata_index.has(original_path, original_path.stat().st_mtime):
+                    metadata_index.index_file(original_path)
+                return 'cached'
 
-            # === 保存逻辑 (仅针对 PIL 或 内嵌缩略图 成功的情况) ===
-            img = ImageOps.exif_transpose(img)  # 处理手机照片的旋转
-            if img.mode != "RGB":
-                img = img.convert("RGB")
+            # [新增] 负缓存：最近失败过且源文件没变，退避期内直接放弃，不再跑整条解码链
+            if failures.should_skip(original_path):
+                return None
 
-            # 缩放并保存
-            img.thumbnail(state.thumb_size, Image.Resampling.LANCZOS)
-            img.save(preview_path, "JPEG", quality=state.thumb_quality, optimize=True)
-            return True
+            with self.lock_for(preview_path):
+                # 等锁期间可能已被其他线程 (其他相册里的同一张图) 生成
+                if preview_path.exists() and preview_path.stat().st_size > 100:
+                    return 'cached'
+                return self._render(original_path, preview_path)
 
         except Exception as e:
             # 这里的日志级别改为 ERROR，确保你能看到为什么失败
             logger.error(f"生成预览图最终失败: {original_path} \n原因: {e}")
-            return False
+            failures.record_failure(original_path, str(e))
+            return None
+
+    def _render(self, original_path: Path, preview_path: Path) -> str | None:
+        from PIL import Image
+
+        preview_path.parent.mkdir(parents=True, exist_ok=True)
+        # [新增] 先写临时文件再改名，预览被多个相册共享，读者不会读到写了一半的文件
+        tmp_path = preview_path.with_name(preview_path.name + '.part')
+        img = None
+        method = 'pil'
+
+        # 定义 RAW 扩展名集合
+        raw_exts = {'.cr2', '.cr3', '.nef', '.arw', '.dng', '.orf', '.rw2', '.pef', '.sr2'}
+        is_raw = original_path.suffix.lower() in raw_exts
+
+        # [尝试 1] 直接用 PIL 打开 (适合 JPG, PNG, 部分简单 RAW)
+        # [修改] Image.open 只读文件头，解码在预算内进行
+        # [新增] 顺带读取 EXIF 写入元数据索引 (只读文件头，不额外打开文件)
+        indexed = False
+        try:
+            with Image.open(original_path) as im:
+                metadata_index.index_file(original_path, im)
+                indexed = True
+                img = self.decode_thumbnail(im)
+        except Exception:
+            img = None
+        if not indexed:
+            metadata_index.index_file(original_path)
+
+        # [尝试 2] 如果是 RAW 且 PIL 失败，尝试提取内嵌预览图
+        if img is None and is_raw:
+            method = 'embedded'
+            embedded = self.extract_embedded_thumbnail(original_path)
+            if embedded is not None:
+                try:
+                    img = self.decode_thumbnail(embedded)
+                except Exception:
+                    img = None
+
+        # [尝试 3] 如果前两者都失败，且是 RAW，调用 ImageMagick
+        if img is None and is_raw:
+            # 注意：Magick 会直接生成文件，不需要后续的 PIL save 操作
+            if self.generate_raw_preview_with_magick(original_path, tmp_path):
+                os.replace(tmp_path, preview_path)
+                failures.clear(original_path)
+                return 'magick'
+            tmp_path.unlink(missing_ok=True)
+            failures.record_failure(original_path, "PIL、内嵌缩略图、Magick 均失败")
+            return None
+
+        # 如果以上方法都无法获取图像对象，则宣告失败
+        if img is None:
+            failures.record_failure(original_path, "PIL 无法打开该文件")
+            return None
+
+        # === 保存逻辑 (仅针对 PIL 或 内嵌缩略图 成功的情况，img 已是缩放后的 RGB 图) ===
+        try:
+            img.save(tmp_path, "JPEG", quality=state.thumb_quality, optimize=True)
+            os.replace(tmp_path, preview_path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+        failures.clear(original_path)
+        return method
+
+    def generate_task(self, original_path):
+        # [修改] 后台预热任务先向自适应限流器申请名额，前台繁忙时自动让路
+        with warmup_throttle.background_slot():
+            preview_path = preview_store.path_for(original_path)
+            if not preview_path.exists():
+                try:
+                    warmup_throttle.consume_io(original_path.stat().st_size)
+                except OSError:
+                    pass
+            # 预览已存在时只补建元数据索引
+            self.generate_sync(original_path, preview_path)
 
-    def generate_task(self, original_path, preview_path):
-        self.generate_sync(original_path, preview_path)
+    @staticmethod
+    def iter_sources(root_path: Path):
+        """
+        [新增] 遍历一个照片根目录下所有相册里的图片，产出 (文件路径, 相对根目录的路径)。
+        跳过系统文件夹，以及被排在前面的根目录中同名相册遮住的相册 (网页上访问不到)。
+        """
+        cache = resolver.canonical(state.preview_root())
+        for item in root_path.iterdir():
+            # 跳过系统文件夹
+            if item.name in (state.marked_subdir, state.preview_subdir) or item == cache:
+                continue
+            if not item.is_dir():
+                continue
+            if resolve_album(item.name)[0] != root_path:
+                continue
 
-    def scan_all(self, root_path: Path):
-        if not root_path.exists():
-            return
+            for file_path in item.rglob("*"):
+                if not file_path.is_file():
+                    continue
+                if file_path.suffix.lower() not in state.allowed_extensions:
+                    continue
+                # 防御性检查
+                if state.marked_subdir in file_path.parts or state.preview_subdir in file_path.parts:
+                    continue
+                try:
+                    yield file_path, file_path.relative_to(root_path)
+                except ValueError:
+                    continue
+
+    def scan_all(self):
+        """[修改] 扫描所有照片根目录，预览按内容指纹存入 state.preview_root() 下的共享缓存"""
+        warmup_throttle.ensure_started()
         update_global_status("⏳ 正在后台预热缩略图...")
         count = 0
         try:
-            for item in root_path.iterdir():
-                # 跳过系统文件夹
-                if item.name in (state.marked_subdir, state.preview_subdir):
+            for root in state.roots:
+                root_path = Path(root)
+                if not root_path.exists():
                     continue
-
-                if item.is_dir():
-                    for file_path in item.rglob("*"):
-                        if not file_path.is_file():
-                            continue
-                        if file_path.suffix.lower() not in state.allowed_extensions:
-                            continue
-                        # 防御性检查
-                        if state.marked_subdir in file_path.parts or state.preview_subdir in file_path.parts:
-                            continue
-
-                        try:
-                            rel_path = file_path.relative_to(root_path)
-                            preview_path = root_path / state.preview_subdir / rel_path
-
-                            if str(preview_path) not in self.scanned_files:
-                                if not preview_path.exists():
-                                    self.executor.submit(self.generate_task, file_path, preview_path)
-                                    count += 1
-                                self.scanned_files.add(str(preview_path))
-                        except ValueError:
-                            continue
+                # 与 safe_join 一致使用规范化路径，失败记录等按路径索引的数据才能对得上
+                root_path = resolver.canonical(root)
+
+                for file_path, _ in self.iter_sources(root_path):
+                    if str(file_path) in self.scanned_files:
+                        continue
+                    self.scanned_files.add(str(file_path))
+                    # 指纹的计算 (读原图) 放在受限流控制的后台任务里，这里只查引用记录
+                    st = file_path.stat()
+                    preview_path = preview_store.lookup(file_path, st)
+                    if preview_path is not None and preview_path.exists():
+                        # [新增] 预览已有但元数据索引缺失 / 过期时，也提交一个 (只读文件头的) 任务
+                        if not metadata_index.has(file_path, st.st_mtime):
+                            self.executor.submit(self.generate_task, file_path)
+                    elif not failures.should_skip(file_path):
+                        self.executor.submit(self.generate_task, file_path)
+                        count += 1
 
             if count > 0:
                 update_global_status(f"⚡ 处理中: {count} 张新图片")
@@ -266,6 +1469,34 @@ class PreviewGenerator:
 generator = PreviewGenerator()
 
 
+def runtime_stats_lines() -> list:
+    """[新增] GUI「运行状态」窗口显示的各项运行指标"""
+    b = decode_budget.snapshot()
+    lines = [
+        "【解码内存预算】",
+        f"  占用: {b['used_mb']:.0f} / {b['capacity_mb']:.0f} MB   峰值: {b['peak_mb']:.0f} MB",
+        f"  解码中: {b['active']}   排队: {b['waiting']}   缩小解码: {b['reduced']} 次",
+    ]
+    refs, blobs = preview_store.stats()
+    lines.append(f"【预览缓存】 {refs} 张原图共用 {blobs} 份预览 (去重节省 {refs - blobs} 份)")
+    r = resolver.snapshot()
+    lines.append(f"【路径解析缓存】 相册 {r['albums']} 个   命中 {r['hits']} / 未命中 {r['misses']}")
+    w = warmup_throttle.snapshot()
+    lines += [
+        "【后台预热限流】",
+        f"  前台 p90 延迟: {w['p90_ms']:.0f} ms (目标 {state.warmup_latency_target_ms} ms)   前台并发: {w['fg_inflight']}",
+        f"  预热名额: {w['active']} / {w['limit']}   读盘限速: " +
+        (f"{w['io_mbps']:.1f} MB/s" if w['io_mbps'] else "不限"),
+    ]
+    transfers = traffic_shaper.snapshot()
+    lines.append(f"【原图传输】 {len(transfers)} / {state.original_max_total}" +
+                 ("   (预览优先中)" if traffic_shaper.previews_busy() else ""))
+    for t in transfers:
+        lines.append(f"  {t['client']:<24} {t['name'][:24]:<24} "
+                     f"{t['sent'] / 1024 / 1024:6.1f}/{t['size'] / 1024 / 1024:.1f} MB  {t['rate_kbps']:7.0f} KB/s")
+    return lines
+
+
 def get_ipv6_addresses_v2():
     addrs = set()
     try:
@@ -296,10 +1527,34 @@ def get_ipv6_addresses_v2():
 app = Flask(__name__)
 
 
+# [新增] 前台图片请求计入预热限流器的延迟统计
+FOREGROUND_ENDPOINTS = {'get_preview', 'get_original'}
+
+
+@app.before_request
+def track_foreground_start():
+    if request.endpoint in FOREGROUND_ENDPOINTS:
+        g.fg_started = time.time()
+        warmup_throttle.foreground_started()
+
+
+@app.teardown_request
+def track_foreground_end(exc):
+    started = g.pop('fg_started', None)
+    if started is not None:
+        warmup_throttle.foreground_finished(time.time() - started)
+
+
 @app.after_request
 def add_header(response):
-    if 'image' in response.mimetype:
+    if response.headers.get('X-Preview-Placeholder') or response.headers.get('X-Preview-Final') == '0':
+        # 占位图 / 渐进式预览的先行版不能被浏览器长期缓存，否则客户一直看到的都是它们
+        response.headers['Cache-Control'] = 'no-store'
+    elif 'image' in response.mimetype:
         response.headers['Cache-Control'] = 'public, max-age=604800'
+    # [修改] 预览优先按响应体实际发送的时间计 (等待生成 / 渐进式预览等待完整版的请求不压低原图带宽)
+    if request.endpoint == 'get_preview' and response.status_code in (200, 206):
+        traffic_shaper.wrap_preview(response)
     return response
 
 
@@ -405,22 +1660,49 @@ ALBUM_TEMPLATE = '''
         pointer-events: none;
         filter: grayscale(100%);
     }
+    /* [新增] 排序 / 筛选栏 */
+    .filter-bar { display: none; position: fixed; left: 0; right: 0; z-index: 99;
+        top: calc(44px + env(safe-area-inset-top)); padding: 8px 10px; gap: 6px; flex-wrap: wrap;
+        background: var(--bar-bg); backdrop-filter: blur(20px); -webkit-backdrop-filter: blur(20px); }
+    .filter-bar.open { display: flex; }
+    .filter-bar select, .filter-bar input { background: #2c2c2e; color: #fff; border: none; border-radius: 8px; padding: 6px 8px; font-size: 14px; }
+    .filter-bar button { background: var(--accent); color: #fff; border: none; border-radius: 8px; padding: 6px 14px; font-size: 14px; }
+    /* [新增] 虚拟滚动网格：格子绝对定位，随滚动复用 */
+    .grid.vgrid { display: block; position: relative; }
+    .vgrid .cell { position: absolute; top: 0; left: 0; }
+    /* [新增] 渐进式预览的先行版 (低分辨率) 轻微模糊，完整预览到达后恢复 */
+    img.interim { filter: blur(3px); }
     </style>
 </head>
 <body>
     <div class="navbar">
         <a href="/" class="nav-btn">''' + ICONS['back'] + '''&nbsp;返回</a>
         <div class="nav-title">{{ album_name }}</div>
-        <div style="width: 44px;"></div>
+        <button class="nav-btn" onclick="document.getElementById('filter-bar').classList.toggle('open')">筛选</button>
     </div>
 
-    <div class="grid">
-        {% for photo in photos %}
-        <div class="cell" onclick="openViewer({{ loop.index0 }})">
-            <img data-src="{{ photo.preview }}" loading="lazy">
-        </div>
-        {% endfor %}
-    </div>
+    <form class="filter-bar" id="filter-bar" method="get">
+        <select name="sort">
+            <option value="time" {% if current.sort in ('', 'time') %}selected{% endif %}>拍摄时间</option>
+            <option value="time_desc" {% if current.sort == 'time_desc' %}selected{% endif %}>时间倒序</option>
+            <option value="name" {% if current.sort == 'name' %}selected{% endif %}>文件名</option>
+        </select>
+        <select name="camera">
+            <option value="">全部机身</option>
+            {% for c in cameras %}<option {% if c == current.camera %}selected{% endif %}>{{ c }}</option>{% endfor %}
+        </select>
+        <select name="kind">
+            <option value="">全部格式</option>
+            <option value="raw" {% if current.kind == 'raw' %}selected{% endif %}>RAW</option>
+            <option value="jpeg" {% if current.kind == 'jpeg' %}selected{% endif %}>JPEG 等</option>
+        </select>
+        <input type="date" name="from" value="{{ current['from'] }}">
+        <input type="date" name="to" value="{{ current.to }}">
+        {% if current.grid %}<input type="hidden" name="grid" value="{{ current.grid }}">{% endif %}
+        <button>应用</button>
+    </form>
+
+    <div class="grid{% if virtual %} vgrid{% endif %}" id="grid"></div>
 
     <div class="viewer" id="viewer">
         <div class="v-header">
@@ -459,25 +1741,165 @@ ALBUM_TEMPLATE = '''
     </div>
 
     <script>
-        const photos = {{ photos | tojson }};
+        // [修改] 服务端只下发紧凑列表 (文件名 / 是否 RAW / 宽高比)，URL 在前端按需拼接
+        const listing = {{ listing | tojson }};
+        const VIRTUAL = {{ 'true' if virtual else 'false' }};
+        const PROGRESSIVE = {{ 'true' if progressive else 'false' }};
+        const PREFETCH = {{ prefetch | tojson }};
         const albumName = "{{ album_name }}";
+        const photoCount = listing.files.length;
         let curIdx = 0;
         let isOrig = false;
+        let lastDir = 1;   // [新增] 最近一次翻页方向，1 向后 / -1 向前
 
         let markedState = {}; 
 
-        // Lazy Load Logic
-        const observer = new IntersectionObserver((entries, obs) => {
-            entries.forEach(e => {
-                if(e.isIntersecting) {
-                    const img = e.target;
-                    img.src = img.dataset.src;
-                    img.onload = () => img.classList.add('loaded');
-                    obs.unobserve(img);
+        function encodePath(p) { return p.split('/').map(encodeURIComponent).join('/'); }
+
+        function photoAt(i) {
+            const f = listing.files[i];
+            return {
+                filename: f,
+                preview: listing.preview_base + encodePath(f),
+                original: listing.original_base + encodePath(f),
+                is_raw: listing.raw[i] === 1,
+                ar: listing.ar[i]
+            };
+        }
+
+        // [新增] 渐进式加载：先显示服务端的先行版 (X-Preview-Final: 0)，完整预览生成好后原地替换
+        // 格子被复用 / 移出可见区域 / 查看器关闭时取消：中止 fetch 和等待完整预览的请求，释放先行版
+        function cancelPreview(img) {
+            img._token = (img._token || 0) + 1;
+            if (img._abort) { img._abort.abort(); img._abort = null; }
+            if (img._probe) { img._probe.onload = null; img._probe.src = ''; img._probe = null; }
+            if (img._blob) { URL.revokeObjectURL(img._blob); img._blob = null; }
+            img.classList.remove('interim');
+        }
+
+        function loadPreview(img, url) {
+            cancelPreview(img);
+            if (!PROGRESSIVE) { img.src = url; return; }
+            const token = img._token;
+            const ctrl = img._abort = new AbortController();
+            fetch(url, {headers: {'X-Preview-Progressive': '1'}, signal: ctrl.signal}).then(r => r.blob().then(b => {
+                if (img._token !== token) return;
+                img._abort = null;
+                // 最终预览直接显示已取到的内容，不再重复请求；显示出来后立即释放 blob，不在页面里常驻
+                const blobUrl = img._blob = URL.createObjectURL(b);
+                img.src = blobUrl;
+                if (r.headers.get('X-Preview-Final') !== '0') {
+                    img.addEventListener('load', () => {
+                        if (img._blob === blobUrl) { URL.revokeObjectURL(blobUrl); img._blob = null; }
+                    }, {once: true});
+                    return;
+                }
+                img.classList.add('interim');
+                const probe = img._probe = new Image();   // 该请求会等到服务端生成完整预览
+                probe.onload = () => {
+                    if (img._token !== token) return;
+                    img._probe = null;
+                    img.src = url;
+                    img.classList.remove('interim');
+                    URL.revokeObjectURL(img._blob);
+                    img._blob = null;
+                };
+                probe.src = url;
+            })).catch(() => { if (img._token === token && !ctrl.signal.aborted) img.src = url; });
+        }
+
+        const grid = document.getElementById('grid');
+
+        function createCell() {
+            const cell = document.createElement('div');
+            cell.className = 'cell';
+            cell.onclick = () => openViewer(+cell.dataset.idx);
+            const img = document.createElement('img');
+            img.decoding = 'async';
+            img.onload = () => img.classList.add('loaded');
+            cell.appendChild(img);
+            return cell;
+        }
+
+        if (!VIRTUAL) {
+            // Lazy Load Logic (普通网格：每张照片一个格子)
+            const observer = new IntersectionObserver((entries, obs) => {
+                entries.forEach(e => {
+                    if(e.isIntersecting) {
+                        const img = e.target;
+                        loadPreview(img, img.dataset.src);
+                        obs.unobserve(img);
+                    }
+                });
+            }, {rootMargin: "200px"});
+            for (let i = 0; i < photoCount; i++) {
+                const cell = createCell();
+                cell.dataset.idx = i;
+                cell.firstChild.dataset.src = photoAt(i).preview;
+                grid.appendChild(cell);
+                observer.observe(cell.firstChild);
+            }
+        }
+
+        // [新增] 虚拟滚动网格：只保留可见行 + 上下 OVERSCAN 行的格子，滚动时复用，DOM 大小与相册大小无关
+        const OVERSCAN = 3;
+        const cells = new Map();   // 照片序号 -> 正在显示它的格子
+        const spare = [];          // 空闲格子
+        let cols = 3, size = 0, gap = 2, padTop = 0, padLeft = 0, rafPending = false;
+
+        function layoutGrid() {
+            const cs = getComputedStyle(grid);
+            padTop = parseFloat(cs.paddingTop);
+            padLeft = parseFloat(cs.paddingLeft);
+            const innerW = grid.clientWidth - padLeft - parseFloat(cs.paddingRight);
+            const wide = window.innerWidth >= 600;   // 与 CSS 中的断点保持一致
+            gap = wide ? 4 : 2;
+            cols = wide ? Math.max(1, Math.floor((innerW + gap) / (150 + gap))) : 3;
+            size = (innerW - gap * (cols - 1)) / cols;
+            const rows = Math.ceil(photoCount / cols);
+            grid.style.height = Math.max(0, rows * (size + gap) - gap) + 'px';
+            cells.forEach(cell => { cell.style.display = 'none'; spare.push(cell); });
+            cells.clear();
+            renderWindow();
+        }
+
+        function renderWindow() {
+            rafPending = false;
+            const rowH = size + gap;
+            const top = window.scrollY - grid.offsetTop - padTop;
+            const firstRow = Math.max(0, Math.floor(top / rowH) - OVERSCAN);
+            const lastRow = Math.floor((top + window.innerHeight) / rowH) + OVERSCAN;
+            const first = firstRow * cols, last = Math.min(photoCount - 1, (lastRow + 1) * cols - 1);
+
+            cells.forEach((cell, idx) => {
+                if (idx < first || idx > last) {
+                    cells.delete(idx); cell.style.display = 'none'; cancelPreview(cell.firstChild); spare.push(cell);
                 }
             });
-        }, {rootMargin: "200px"});
-        document.querySelectorAll('img[data-src]').forEach(img => observer.observe(img));
+            for (let i = first; i <= last; i++) {
+                if (cells.has(i)) continue;
+                let cell = spare.pop();
+                if (!cell) { cell = createCell(); grid.appendChild(cell); }
+                const img = cell.firstChild;
+                cell.dataset.idx = i;
+                cell.style.width = cell.style.height = size + 'px';
+                cell.style.transform = `translate(${padLeft + (i % cols) * (size + gap)}px, ${padTop + Math.floor(i / cols) * (size + gap)}px)`;
+                cell.style.display = '';
+                img.classList.remove('loaded');
+                loadPreview(img, photoAt(i).preview);
+                cells.set(i, cell);
+            }
+        }
+
+        function scheduleRender() {
+            if (!rafPending) { rafPending = true; requestAnimationFrame(renderWindow); }
+        }
+
+        if (VIRTUAL) {
+            window.addEventListener('scroll', scheduleRender, {passive: true});
+            window.addEventListener('resize', layoutGrid);
+            layoutGrid();
+        }
 
         // Viewer Logic
         const viewer = document.getElementById('viewer');
@@ -498,14 +1920,24 @@ ALBUM_TEMPLATE = '''
 
         function openViewer(idx) { 
             curIdx = idx; 
+            lastDir = 1;
             viewer.style.display = 'flex'; 
             loadPhoto(); 
         }
 
         function closeViewer() { 
             viewer.style.display = 'none'; 
+            cancelPreview(vImg);
             vImg.src = '';
             showLoading(false); 
+            clearPrefetch();
+            // [新增] 虚拟网格中，关闭查看器后滚动到刚才看的那张
+            if (VIRTUAL) {
+                const y = grid.offsetTop + padTop + Math.floor(curIdx / cols) * (size + gap);
+                if (y < window.scrollY || y + size > window.scrollY + window.innerHeight) {
+                    window.scrollTo(0, y - window.innerHeight / 2 + size / 2);
+                }
+            }
         }
 
         function loadPhoto() {
@@ -515,14 +1947,18 @@ ALBUM_TEMPLATE = '''
 
             // 加载预览图
             vImg.style.opacity = 0.3;
-            vImg.src = photos[curIdx].preview;
-            vImg.onload = () => vImg.style.opacity = 1;
+            const photo = photoAt(curIdx);
+            // 预览加载完成前按宽高比占位，避免布局跳动
+            vImg.style.aspectRatio = photo.ar || '';
+            vImg.onload = () => { vImg.style.opacity = 1; vImg.style.aspectRatio = ''; };
+            loadPreview(vImg, photo.preview);
+            prefetchAround();
 
             // [修改] 更新原图按钮状态（检查是否为 RAW）
             updateOrigUI();
 
             // 检查收藏状态
-            const currentFile = photos[curIdx].filename;
+            const currentFile = photo.filename;
             if (currentFile in markedState) {
                 renderMark(markedState[currentFile]);
             } else {
@@ -530,17 +1966,54 @@ ALBUM_TEMPLATE = '''
                 fetch(`/api/check_mark?album=${encodeURIComponent(albumName)}&filename=${encodeURIComponent(currentFile)}`)
                     .then(r=>r.json()).then(d => {
                         markedState[currentFile] = d.is_marked;
-                        if(curIdx === photos.findIndex(p => p.filename === currentFile)) {
+                        if(listing.files[curIdx] === currentFile) {
                             renderMark(d.is_marked);
                         }
                     });
             }
         }
 
+        // [新增] 查看器预取：沿翻页方向保持 PREFETCH.ahead 张 (反方向 PREFETCH.behind 张) 的预览在浏览器里就绪，
+        // 由服务端预热这些照片的预览缓存并返回地址；窗口外的预加载会被取消
+        const prefetched = new Map();   // 文件名 -> Image (保持引用直到移出窗口)
+        function prefetchAround() {
+            if (!PREFETCH.ahead && !PREFETCH.behind) return;
+            const order = [];
+            for (let k = 1; k <= PREFETCH.ahead; k++) order.push(curIdx + lastDir * k);
+            for (let k = 1; k <= PREFETCH.behind; k++) order.push(curIdx - lastDir * k);
+            const wanted = order.filter(i => i >= 0 && i < photoCount).map(i => listing.files[i]);
+            const keep = new Set(wanted.concat([listing.files[curIdx]]));
+            for (const [f, im] of prefetched) {
+                if (!keep.has(f)) { if (im) im.src = ''; prefetched.delete(f); }
+            }
+            const files = wanted.filter(f => !prefetched.has(f));
+            if (!files.length) return;
+            files.forEach(f => prefetched.set(f, null));   // 请求途中不重复提交
+            fetch('/api/prefetch', {
+                method: 'POST', headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({album: albumName, files: files})
+            }).then(r => r.json()).then(d => {
+                d.files.forEach((f, i) => {
+                    if (!prefetched.has(f) || prefetched.get(f)) return;   // 已移出窗口
+                    const im = new Image();
+                    im.src = d.urls[i];
+                    prefetched.set(f, im);
+                });
+                // 服务端拒绝的 (不存在 / 生成失败) 从占位中移除，下次还会再问
+                files.forEach(f => { if (prefetched.get(f) === null) prefetched.delete(f); });
+            }).catch(() => files.forEach(f => { if (prefetched.get(f) === null) prefetched.delete(f); }));
+        }
+
+        function clearPrefetch() {
+            for (const im of prefetched.values()) { if (im) im.src = ''; }
+            prefetched.clear();
+        }
+
         function next(e) { 
             if(e) e.stopPropagation(); 
-            if(curIdx < photos.length - 1) { 
+            if(curIdx < photoCount - 1) { 
                 curIdx++; 
+                lastDir = 1;
                 loadPhoto(); 
             }
         }
@@ -549,6 +2022,7 @@ ALBUM_TEMPLATE = '''
             if(e) e.stopPropagation(); 
             if(curIdx > 0) { 
                 curIdx--; 
+                lastDir = -1;
                 loadPhoto(); 
             }
         }
@@ -556,7 +2030,7 @@ ALBUM_TEMPLATE = '''
         function toggleOriginal(e) {
             e.stopPropagation();
             // 如果是 RAW 文件，直接忽略点击（虽然 CSS 已经禁用了 pointer-events，这里做双重保险）
-            if (photos[curIdx].is_raw) return;
+            if (photoAt(curIdx).is_raw) return;
 
             const isNowOriginal = !isOrig;
             isOrig = isNowOriginal;
@@ -569,6 +2043,7 @@ ALBUM_TEMPLATE = '''
                 const tempImg = new Image();
                 tempImg.onload = () => {
                     showLoading(false); 
+                    cancelPreview(vImg);   // 避免仍在等待的完整预览把原图换回去
                     vImg.src = tempImg.src;
                     vImg.style.opacity = 1;
                 };
@@ -577,17 +2052,17 @@ ALBUM_TEMPLATE = '''
                     alert('加载原图失败或文件不存在。');
                     vImg.style.opacity = 1; 
                 };
-                tempImg.src = photos[curIdx].original; 
+                tempImg.src = photoAt(curIdx).original; 
             } else {
                 showLoading(false); 
-                vImg.src = photos[curIdx].preview;
+                loadPreview(vImg, photoAt(curIdx).preview);
                 vImg.style.opacity = 1;
             }
         }
 
         function updateOrigUI() {
             // [新增] 检查当前图片是否为 RAW
-            const isRaw = photos[curIdx].is_raw;
+            const isRaw = photoAt(curIdx).is_raw;
 
             if (isRaw) {
                 // 如果是 RAW，禁用按钮并变灰
@@ -604,7 +2079,7 @@ ALBUM_TEMPLATE = '''
 
         function toggleMark(e) {
             e.stopPropagation();
-            const currentFile = photos[curIdx].filename;
+            const currentFile = listing.files[curIdx];
             const nextState = !markedState[currentFile];
 
             markedState[currentFile] = nextState;
@@ -678,19 +2153,53 @@ def album_view(album_name):
     if album_name == state.marked_subdir or album_name == state.preview_subdir:
         return "⛔ 禁止访问系统缓存文件夹", 403
 
-    path = safe_join(state.base_dir, album_name)
-    if not path or not path.exists():
+    # [修改] 在所有照片根目录中查找相册 (resolve_album 已排除预览 / 标记等系统文件夹)
+    root, path = resolve_album(album_name)
+    if not path:
         return "相册不存在", 404
 
-    # 额外检查：解析后的路径是否指向预览或标记目录
-    try:
-        rel_path = path.relative_to(Path(state.base_dir).resolve())
-        if rel_path.parts and (rel_path.parts[0] == state.marked_subdir or rel_path.parts[0] == state.preview_subdir):
-            return "⛔ 禁止访问系统文件夹", 403
-    except ValueError:
-        pass  # 路径不在 base_dir 下，后续 404 处理
+    entries, cameras = list_album_photos(root, path, request.args)
+    listing = compact_listing(album_name, entries)
+
+    grid_mode = request.args.get('grid', '')
+    virtual = grid_mode == 'virtual' or (grid_mode != 'full' and len(entries) > state.virtual_grid_threshold)
+    current = {k: request.args.get(k, '') for k in ('sort', 'camera', 'kind', 'from', 'to', 'grid')}
+    return render_template_string(ALBUM_TEMPLATE, album_name=album_name, listing=listing, virtual=virtual,
+                                  progressive=state.progressive_previews, cameras=cameras, current=current,
+                                  prefetch={'ahead': state.prefetch_ahead, 'behind': state.prefetch_behind})
+
+
+def compact_listing(album_name: str, entries: list) -> dict:
+    """
+    [新增] 相册的紧凑列表：序号即数组下标，预览 / 原图 URL 由 base + 文件名拼出，
+    raw 为 0/1，ar 为显示方向的宽高比 (未建立元数据索引时为 0)。上万张照片也只有几百 KB。
+    """
+    album_url = urllib.parse.quote(album_name)
+    files, raw, ar = [], [], []
+    for rel, is_raw_file, meta in entries:
+        files.append(rel)
+        raw.append(1 if is_raw_file else 0)
+        ar.append(round(meta['width'] / meta['height'], 3) if meta and meta['height'] else 0)
+    return {
+        'preview_base': f"/file/preview/{album_url}/",
+        'original_base': f"/file/original/{album_url}/",
+        'files': files,
+        'raw': raw,
+        'ar': ar,
+    }
+
 
-    photos = []
+def list_album_photos(root: Path, path: Path, args):
+    """
+    [新增] 列出相册内的照片，并按元数据索引排序 / 筛选 (不打开任何图片文件)。
+    args 支持 sort=time|time_desc|name、camera、kind=raw|jpeg、from / to (YYYY-MM-DD)。
+    返回 ([(相对相册的路径, 是否 RAW, 元数据或 None), ...], 相册内出现过的机身列表)。
+    """
+    rel_album = path.relative_to(root)
+    index = metadata_index.album(rel_album.parts[0])
+    prefix = Path(*rel_album.parts[1:])
+
+    entries = []
     for f in path.rglob("*"):
         if f.is_file() and f.suffix.lower() in state.allowed_extensions:
             # 双重保险：跳过任何包含系统目录的文件
@@ -698,68 +2207,203 @@ def album_view(album_name):
                 continue
             try:
                 rel = f.relative_to(path).as_posix()
-
-                # [新增] 判断是否为 RAW 文件
-                is_raw_file = f.suffix.lower() in state.raw_extensions
-
-                photos.append({
-                    'filename': rel,
-                    'preview': url_for('get_preview', album=album_name, filename=rel),
-                    'original': url_for('get_original', album=album_name, filename=rel),
-                    'is_raw': is_raw_file  # 将此标记传递给前端
-                })
-            except:
+            except ValueError:
                 continue
-    return render_template_string(ALBUM_TEMPLATE, album_name=album_name, photos=photos)
+            # [新增] 判断是否为 RAW 文件
+            is_raw_file = f.suffix.lower() in state.raw_extensions
+            entries.append((rel, is_raw_file, index.get((prefix / rel).as_posix())))
+
+    cameras = sorted({m['camera'] for _, _, m in entries if m and m['camera']})
+
+    kind, camera = args.get('kind', ''), args.get('camera', '')
+    date_from, date_to = args.get('from', ''), args.get('to', '')
+    if kind:
+        entries = [e for e in entries if e[1] == (kind == 'raw')]
+    if camera:
+        entries = [e for e in entries if e[2] and e[2]['camera'] == camera]
+    if date_from:
+        entries = [e for e in entries if e[2] and e[2]['taken'][:10] >= date_from]
+    if date_to:
+        entries = [e for e in entries if e[2] and e[2]['taken'][:10] <= date_to]
+
+    # 默认按拍摄时间排序；尚未建立索引的照片排在最后，按文件名
+    sort = args.get('sort', 'time')
+    entries.sort(key=lambda e: e[0])
+    if sort in ('time', 'time_desc'):
+        indexed = [e for e in entries if e[2]]
+        indexed.sort(key=lambda e: e[2]['taken'], reverse=(sort == 'time_desc'))
+        entries = indexed + [e for e in entries if not e[2]]
+    return entries, cameras
 
 
 @app.route('/file/preview/<path:album>/<path:filename>')
 @app.route('/file/preview/<path:album>/<path:filename>')
 def get_preview(album, filename):
-    # 原始文件的完整路径 (state.base_dir / album / filename)
-    original_path = safe_join(state.base_dir, album, filename)
-    if not original_path or not original_path.exists():
+    # 原始文件的完整路径 (相册所在根目录 / album / filename)
+    root, album_dir = resolve_album(album)
+    original_path = safe_join(str(album_dir), filename) if album_dir else None
+    if not original_path or not original_path.is_file():
         abort(404)
 
     # 计算预览文件的完整路径
-    # 预览路径 = 根目录 / 预览子目录 / album / filename
-    # 注意：Path(state.base_dir) / state.preview_subdir 是预览缓存的根目录
-    # album/filename 是相对于共享根目录的路径部分
-    preview_path = safe_join(str(Path(state.base_dir) / state.preview_subdir), album, filename)
-
-    if not preview_path: abort(404)
+    # [修改] 预览按原图内容指纹存放 (state.preview_root()/._blobs/...)，多个相册里的同一张图共用一份
+    preview_path = preview_store.path_for(original_path)
 
     # 检查预览文件是否存在
     if not preview_path.exists():
+        # [新增] 渐进模式 (前端带 X-Preview-Progressive 请求头)：先返回廉价的先行版，完整预览在后台生成，
+        # 前端随后再请求同一地址 (会等到生成完成) 替换掉先行版
+        if state.progressive_previews and request.headers.get('X-Preview-Progressive') \
+                and not failures.should_skip(original_path):
+            quick = generator.quick_preview(original_path)
+            if quick:
+                generator.render_async(original_path, preview_path)
+                response = send_file(BytesIO(quick), mimetype='image/jpeg')
+                response.headers['X-Preview-Final'] = '0'
+                return response
+
         # 如果不存在，则生成它
         success = generator.generate_sync(original_path, preview_path)
         if not success:
-            # 如果生成失败，直接返回原图，但不返回原图的 mime-type
-            # 这是一个简单的降级策略，虽然返回原图，但文件路径仍是 /file/preview/...
-            return send_file(original_path)
+            # [修改] 生成失败 (或仍在退避期内) 时返回很小的占位图，不再把巨大的原图当作预览发出去
+            return placeholder_response()
+
+    return offload_response(preview_path) or send_file(preview_path)
+
 
-    return send_file(preview_path)
+def from_trusted_proxy() -> bool:
+    """[新增] 请求是否经由可信的前端代理：启用了卸载、对端是 trusted_proxies 中的地址且带 X-PicShare-Offload"""
+    return bool(state.offload_mode and request.remote_addr in state.trusted_proxies
+                and request.headers.get('X-PicShare-Offload'))
+
+
+def client_address() -> str:
+    """
+    [新增] 客户端地址。只有可信代理转来的请求才读代理传来的地址：优先 X-Real-IP，
+    其次 X-Forwarded-For 的最后一跳 (前面的条目可能是客户端自己伪造的)。
+    """
+    if from_trusted_proxy():
+        forwarded = request.headers.get('X-Real-IP', '').strip() or \
+                    request.headers.get('X-Forwarded-For', '').split(',')[-1].strip()
+        if forwarded:
+            return forwarded
+    return request.remote_addr or '?'
+
+
+def offload_locations() -> list:
+    """[新增] 代理内部 location 与磁盘目录的对应关系：[(内部 URI 前缀, 目录), ...]"""
+    # 缓存目录在前：缓存放在某个根目录里时，预览也走 cache location
+    locations = [(f"{state.offload_prefix}/cache/", resolver.canonical(state.preview_root()))]
+    locations += [(f"{state.offload_prefix}/root{i}/", resolver.canonical(root)) for i, root in enumerate(state.roots)]
+    return locations
+
+
+def offload_response(path: Path):
+    """
+    [新增] 把文件传输交给前端代理：路径检查和授权已经在 Python 里做完，这里只返回一个带内部跳转头的空响应。
+    未启用、请求不是经由代理来的、或路径无法映射到内部 location 时返回 None，由调用方照常 send_file。
+    """
+    if not from_trusted_proxy():
+        return None
+    mimetype = mimetypes.guess_type(path.name)[0] or 'application/octet-stream'
+    response = app.response_class(mimetype=mimetype)
+    if state.offload_mode == 'sendfile':
+        response.headers['X-Sendfile'] = str(path)
+        return response
+    for prefix, directory in offload_locations():
+        try:
+            rel = path.relative_to(directory)
+        except ValueError:
+            continue
+        # nginx 要求 X-Accel-Redirect 中的 URI 已做百分号编码
+        response.headers['X-Accel-Redirect'] = prefix + urllib.parse.quote(rel.as_posix())
+        return response
+    return None
+
+
+def placeholder_response():
+    resp = send_file(BytesIO(PLACEHOLDER_JPEG), mimetype='image/jpeg')
+    resp.headers['X-Preview-Placeholder'] = '1'
+    return resp
 
 
 @app.route('/file/original/<path:album>/<path:filename>')
 def get_original(album, filename):
-    path = safe_join(state.base_dir, album, filename)
-    if not path or not path.exists(): abort(404)
-    return send_file(path)
+    root, album_dir = resolve_album(album)
+    path = safe_join(str(album_dir), filename) if album_dir else None
+    if not path or not path.is_file(): abort(404)
+
+    # [新增] 交给前端代理发送时，并发由代理的 limit_conn 控制，单连接限速通过 X-Accel-Limit-Rate 传给 nginx
+    response = offload_response(path)
+    if response is not None:
+        if state.original_client_kbps and state.offload_mode == 'nginx':
+            response.headers['X-Accel-Limit-Rate'] = str(state.original_client_kbps * 1024)
+        return response
+
+    # [新增] 流量整形：申请传输名额，满员时排队，超时则让客户端稍后重试
+    tid = traffic_shaper.acquire(client_address(), path.name, path.stat().st_size)
+    if tid is None:
+        return "当前下载原图的人数过多，请稍后再试", 429, {'Retry-After': '10'}
+    try:
+        response = send_file(path)
+    except Exception:
+        traffic_shaper.release(tid)
+        raise
+    return traffic_shaper.wrap(response, tid)
+
+
+@app.route('/api/prefetch', methods=['POST'])
+def prefetch():
+    """
+    [新增] 查看器预取：为翻页方向上的相邻照片预热服务端预览缓存，
+    返回可预加载的预览地址 (JSON)，由前端用 Image 预加载。
+    浏览器不会理会 fetch 响应上的 Link: rel=preload，所以这里不发该响应头。
+    files 按优先级排列，最多取 prefetch_ahead + prefetch_behind 张；生成失败处于退避期的照片不预取。
+    """
+    d = request.json or {}
+    album = d.get('album', '')
+    _, album_dir = resolve_album(album)
+    if not album_dir: return jsonify({'files': [], 'urls': []})
+
+    album_url = urllib.parse.quote(album)
+    files, urls = [], []
+    for filename in (d.get('files') or [])[:state.prefetch_ahead + state.prefetch_behind]:
+        original_path = safe_join(str(album_dir), filename)
+        if not original_path or original_path.suffix.lower() not in state.allowed_extensions:
+            continue
+        try:
+            st = original_path.stat()
+        except OSError:
+            continue
+        if failures.should_skip(original_path):
+            continue
+        preview_path = preview_store.lookup(original_path, st)
+        if preview_path is None or not preview_path.exists():
+            generator.render_async(original_path)
+        files.append(filename)
+        # 与前端 encodePath (encodeURIComponent) 的编码一致，预加载和查看器才会命中同一条浏览器缓存
+        urls.append(f"/file/preview/{album_url}/" + urllib.parse.quote(filename, safe="/!~*'()"))
+
+    return jsonify({'files': files, 'urls': urls})
 
 
 @app.route('/api/check_mark')
 def check_mark():
-    p = safe_join(state.base_dir, state.marked_subdir, request.args.get('album'), request.args.get('filename'))
-    return jsonify({'is_marked': p and p.exists()})
+    # [修改] 标记文件夹放在相册所在的根目录下 (同盘复制更快)
+    album = request.args.get('album', '')
+    root, _ = resolve_album(album)
+    p = safe_join(str(root), state.marked_subdir, album, request.args.get('filename', '')) if root else None
+    return jsonify({'is_marked': bool(p and p.exists())})
 
 
 @app.route('/api/toggle_mark', methods=['POST'])
 def toggle_mark():
     d = request.json
-    src = safe_join(state.base_dir, d['album'], d['filename'])
-    dst = safe_join(state.base_dir, state.marked_subdir, d['album'], d['filename'])
-    if not src or not src.exists(): return jsonify({'success': False})
+    root, album_dir = resolve_album(d['album'])
+    if not root: return jsonify({'success': False})
+    src = safe_join(str(album_dir), d['filename'])
+    dst = safe_join(str(root), state.marked_subdir, d['album'], d['filename'])
+    if not src or not src.is_file() or not dst: return jsonify({'success': False})
     try:
         if dst.exists():
             os.remove(dst)
@@ -793,7 +2437,7 @@ class ServerGUI:
         }
 
         root.title("IPv6 Photo Server")
-        root.geometry("480x560")
+        root.geometry("480x720")
         root.configure(bg=self.style['bg'])
 
         style = ttk.Style()
@@ -812,7 +2456,7 @@ class ServerGUI:
 
         self.create_label(card, "📂 相册根目录")
         path_box = tk.Frame(card, bg=self.style['panel'])
-        path_box.pack(fill='x', pady=(5, 20))
+        path_box.pack(fill='x', pady=(5, 5))
 
         self.path_var = tk.StringVar(value=state.base_dir)
         e = tk.Entry(path_box, textvariable=self.path_var, bg=self.style['input'], fg='white',
@@ -823,6 +2467,33 @@ class ServerGUI:
                                bg=self.style['input'], fg='white', relief='flat', font=('Segoe UI', 9))
         btn_browse.pack(side='right', ipady=4, padx=0)
 
+        # [新增] 额外的照片根目录 (每块硬盘一个)
+        extra_box = tk.Frame(card, bg=self.style['panel'])
+        extra_box.pack(fill='x', pady=(0, 15))
+        self.extra_var = tk.StringVar()
+        tk.Label(extra_box, textvariable=self.extra_var, bg=self.style['panel'], fg=self.style['fg'], anchor='w',
+                 justify='left', wraplength=300, font=("Segoe UI", 9)).pack(side='left', fill='x', expand=True)
+        tk.Button(extra_box, text="清空", command=self.clear_extra_roots,
+                  bg=self.style['input'], fg='white', relief='flat', font=('Segoe UI', 9)).pack(side='right', ipady=2)
+        tk.Button(extra_box, text="添加根目录", command=self.add_extra_root,
+                  bg=self.style['input'], fg='white', relief='flat', font=('Segoe UI', 9)
+                  ).pack(side='right', ipady=2, padx=(0, 5))
+        self.update_extra_label()
+
+        # [新增] 预览缓存目录，可放到本地 SSD，避免与原图读取抢同一块慢盘
+        self.create_label(card, "⚡ 预览缓存目录 (留空 = 根目录内)")
+        cache_box = tk.Frame(card, bg=self.style['panel'])
+        cache_box.pack(fill='x', pady=(5, 20))
+        self.cache_var = tk.StringVar(value=state.preview_dir)
+        tk.Entry(cache_box, textvariable=self.cache_var, bg=self.style['input'], fg='white', state='readonly',
+                 readonlybackground=self.style['input'], relief='flat', font=("Segoe UI", 10)
+                 ).pack(side='left', fill='x', expand=True, ipady=8, padx=(0, 10))
+        tk.Button(cache_box, text="默认", command=lambda: self.set_cache_dir(""),
+                  bg=self.style['input'], fg='white', relief='flat', font=('Segoe UI', 9)).pack(side='right', ipady=4)
+        tk.Button(cache_box, text="选择", command=self.browse_cache,
+                  bg=self.style['input'], fg='white', relief='flat', font=('Segoe UI', 9)
+                  ).pack(side='right', ipady=4, padx=(0, 5))
+
         self.create_label(card, "🌐 公网访问地址")
         self.ip_frame = tk.Frame(card, bg=self.style['panel'])
         self.ip_frame.pack(fill='x', pady=(5, 10))
@@ -840,6 +2511,16 @@ class ServerGUI:
                   bg=self.style['input'], fg='white', relief='flat', font=("Microsoft YaHei UI", 10)
                   ).pack(side='left', fill='x', expand=True, ipady=6, padx=(5, 0))
 
+        # [新增] 工具按钮行：查看预览生成失败的文件
+        tools_frame = tk.Frame(card, bg=self.style['panel'])
+        tools_frame.pack(fill='x')
+        tk.Button(tools_frame, text="⚠️ 失败列表", command=self.show_failures,
+                  bg=self.style['input'], fg='white', relief='flat', font=("Microsoft YaHei UI", 10)
+                  ).pack(side='left', fill='x', expand=True, ipady=6, padx=(0, 5))
+        tk.Button(tools_frame, text="📊 运行状态", command=self.show_stats,
+                  bg=self.style['input'], fg='white', relief='flat', font=("Microsoft YaHei UI", 10)
+                  ).pack(side='left', fill='x', expand=True, ipady=6, padx=(5, 0))
+
         tk.Label(card, text="运行日志", bg=self.style['panel'], fg='#666', font=("Segoe UI", 9)).pack(anchor='w',
                                                                                                       pady=(15, 5))
         self.status_var = tk.StringVar(value="正在初始化...")
@@ -848,9 +2529,9 @@ class ServerGUI:
         self.status_lbl.pack(fill='x', ipady=8)
 
         self.refresh()
-        threading.Thread(target=app.run, kwargs={'host': '::', 'port': 5000, 'debug': False, 'use_reloader': False},
+        threading.Thread(target=app.run, kwargs={'host': '::', 'port': state.port, 'debug': False, 'use_reloader': False},
                          daemon=True).start()
-        threading.Thread(target=lambda: generator.scan_all(Path(state.base_dir)), daemon=True).start()
+        self.rescan()
 
     def create_label(self, parent, text):
         tk.Label(parent, text=text, bg=self.style['panel'], fg=self.style['fg'],
@@ -874,7 +2555,38 @@ class ServerGUI:
             self.path_var.set(p)
             state.base_dir = p
             self.refresh()
-            threading.Thread(target=lambda: generator.scan_all(Path(p)), daemon=True).start()
+            self.rescan()
+
+    def rescan(self):
+        """[新增] 根目录或缓存目录变化后重新扫描所有根目录"""
+        generator.scanned_files.clear()
+        resolver.clear()
+        threading.Thread(target=generator.scan_all, daemon=True).start()
+
+    def update_extra_label(self):
+        self.extra_var.set("其他根目录: " + ("; ".join(state.extra_roots) if state.extra_roots else "无"))
+
+    def add_extra_root(self):
+        p = filedialog.askdirectory(initialdir=self.path_var.get())
+        if p and p not in state.roots:
+            state.extra_roots.append(p)
+            self.update_extra_label()
+            self.rescan()
+
+    def clear_extra_roots(self):
+        state.extra_roots = []
+        self.update_extra_label()
+
+    def browse_cache(self):
+        p = filedialog.askdirectory(initialdir=self.cache_var.get() or self.path_var.get())
+        if p:
+            self.set_cache_dir(p)
+
+    def set_cache_dir(self, p):
+        state.preview_dir = p
+        self.cache_var.set(p)
+        self.update_status(f"⚡ 预览缓存: {state.preview_root()}")
+        self.rescan()
 
     def copy_ip(self, event):
         try:
@@ -896,7 +2608,7 @@ class ServerGUI:
             tk.Label(self.ip_frame, text="点击以下任意地址复制完整链接：", bg=self.style['panel'],
                      fg=self.style['fg'], font=("Segoe UI", 9)).pack(anchor='w', pady=(0, 5))
             for ip in ipv6_addrs:
-                url = f"http://[{ip}]:{state.port}"
+                url = f"http://[{ip}]:{state.public_port or state.port}"
                 lbl = tk.Label(
                     self.ip_frame,
                     text=url,
@@ -935,6 +2647,58 @@ class ServerGUI:
         except Exception as e:
             messagebox.showerror("错误", f"复制失败：{e}", parent=self.root)
 
+    def show_failures(self):
+        """[新增] 显示预览生成失败 (处于退避期) 的文件列表"""
+        win = tk.Toplevel(self.root)
+        win.title("预览生成失败的文件")
+        win.geometry("720x360")
+        win.configure(bg=self.style['bg'])
+
+        columns = ('file', 'count', 'retry', 'reason')
+        tree = ttk.Treeview(win, columns=columns, show='headings')
+        for col, title, width in (('file', "文件", 300), ('count', "次数", 50),
+                                  ('retry', "下次重试", 120), ('reason', "原因", 230)):
+            tree.heading(col, text=title)
+            tree.column(col, width=width, anchor='w')
+        tree.pack(fill='both', expand=True, padx=10, pady=(10, 5))
+
+        def fill():
+            tree.delete(*tree.get_children())
+            for path, rec in failures.snapshot():
+                retry = time.strftime('%m-%d %H:%M:%S', time.localtime(rec['next_retry']))
+                tree.insert('', 'end', values=(path, rec['count'], retry, rec['reason']))
+
+        def retry_all():
+            failures.clear_all()
+            self.rescan()
+            fill()
+
+        bar = tk.Frame(win, bg=self.style['bg'])
+        bar.pack(fill='x', padx=10, pady=(0, 10))
+        tk.Button(bar, text="🔄 刷新", command=fill, bg=self.style['input'], fg='white',
+                  relief='flat').pack(side='left', ipady=4, padx=(0, 5))
+        tk.Button(bar, text="♻️ 清除记录并重试", command=retry_all, bg=self.style['accent'], fg='white',
+                  relief='flat').pack(side='left', ipady=4)
+        fill()
+
+    def show_stats(self):
+        """[新增] 每秒刷新的运行状态窗口 (解码预算等)"""
+        win = tk.Toplevel(self.root)
+        win.title("运行状态")
+        win.geometry("640x420")
+        win.configure(bg=self.style['bg'])
+        text_var = tk.StringVar()
+        tk.Label(win, textvariable=text_var, bg=self.style['panel'], fg=self.style['text'], justify='left',
+                 anchor='nw', font=("Consolas", 10), padx=12, pady=12).pack(fill='both', expand=True, padx=10, pady=10)
+
+        def tick():
+            if not win.winfo_exists():
+                return
+            text_var.set("\n".join(runtime_stats_lines()))
+            win.after(1000, tick)
+
+        tick()
+
     def show_help(self):
         help_message = """
 【使用教程】
@@ -947,6 +2711,8 @@ class ServerGUI:
 - 根目录: 存放所有相册子文件夹的主目录（如：F:\\共享照片）。
 - 相册子文件夹: 根目录下包含图片的子文件夹（如：F:\\共享照片\\2025年旅行）。
 - 预览缓存: 程序会自动创建 `._preview_ipv6_opt` 文件夹用于存放缩略图缓存，请勿删除。
+  也可以在「预览缓存目录」中指定其他位置 (推荐本地 SSD)，预览读写就不会和原图读取抢同一块硬盘。
+- 多个根目录: 点击「添加根目录」可以同时共享多块硬盘，相册按添加顺序查找，同名相册以排在前面的为准。
 - 收藏照片: 收藏的照片副本会保存在 `被标记的照片` 文件夹内。
 
 【网络安全风险提示】
@@ -957,7 +2723,349 @@ class ServerGUI:
         messagebox.showinfo("帮助与网络风险提示", help_message)
 
 
-if __name__ == '__main__':
+# ====== 5. 命令行：离线预渲染 (导入照片后 / 夜间运行) ======
+class PrerenderJournal:
+    """
+    预渲染任务日志 (JSON Lines，追加写入)。
+    每处理完一张就写一行 {path, mtime, status, method, reason}，中断后再次运行会跳过已完成的文件。
+    """
+
+    FILE_NAME = "._prerender_journal.jsonl"
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = {}
+        try:
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue  # 上次中断时可能只写了半行
+                    self.done[rec['path']] = rec
+        except FileNotFoundError:
+            pass
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.fp = open(path, 'a', encoding='utf-8')
+
+    def is_done(self, file_path: Path, mtime: float, retry_failed: bool) -> bool:
+        rec = self.done.get(str(file_path))
+        if not rec or rec['mtime'] != mtime:
+            return False
+        return rec['status'] == 'ok' or not retry_failed
+
+    def record(self, file_path: Path, mtime: float, method: str | None, reason: str = ""):
+        rec = {'path': str(file_path), 'mtime': mtime, 'status': 'ok' if method else 'failed',
+               'method': method, 'reason': reason}
+        with self.lock:
+            self.done[rec['path']] = rec
+            self.fp.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            self.fp.flush()
+
+    def close(self):
+        with self.lock:
+            self.fp.close()
+
+
+def format_seconds(seconds: float) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 3600:d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+def run_prerender(args):
+    """离线预渲染所有根目录下的相册，支持断点续跑，结束时输出各文件走的生成路径和失败列表"""
+    roots = [str(Path(r).resolve()) for r in args.roots]
+    state.base_dir, state.extra_roots = roots[0], roots[1:]
+    if args.cache:
+        state.preview_dir = str(Path(args.cache).resolve())
+    # 先检查根目录，避免打错的路径被当作缓存目录创建出来
+    missing = [root for root in state.roots if not Path(root).is_dir()]
+    if missing:
+        for root in missing:
+            print(f"❌ 根目录不存在: {root}")
+        return 2
+    cache = state.preview_root()
+    journal = PrerenderJournal(cache / PrerenderJournal.FILE_NAME)
+
+    # 1. 收集待处理文件 (sources 记下全部照片，汇总报告覆盖之前几次运行的结果)
+    jobs, skipped, sources = [], 0, []
+    for root in state.roots:
+        for file_path, _ in generator.iter_sources(Path(root)):
+            sources.append(str(file_path))
+            st = file_path.stat()
+            if journal.is_done(file_path, st.st_mtime, args.retry_failed):
+                preview_path = preview_store.lookup(file_path, st)
+                if journal.done[str(file_path)]['status'] == 'failed' or (preview_path and preview_path.exists()):
+                    skipped += 1
+                    continue
+            if args.retry_failed:
+                failures.clear(file_path)
+            jobs.append((file_path, st.st_mtime))
+
+    total = len(jobs)
+    print(f"📂 预览缓存: {cache}")
+    print(f"🧾 共 {total + skipped} 张，已完成 {skipped} 张 (断点续跑)，本次处理 {total} 张，{args.workers} 线程")
+
+    # 2. 并发生成，主线程负责进度显示
+    results = {}
+    started = time.time()
+    last_print = 0.0
+
+    def work(file_path, mtime):
+        method = generator.generate_with_method(file_path, preview_store.path_for(file_path))
+        reason = "" if method else dict(failures.snapshot()).get(str(file_path), {}).get('reason', "未知原因")
+        journal.record(file_path, mtime, method, reason)
+        return method, reason
+
+    executor = ThreadPoolExecutor(max_workers=args.workers)
+    try:
+        futures = {executor.submit(work, *job): job[0] for job in jobs}
+        for n, future in enumerate(as_completed(futures), 1):
+            results[futures[future]] = future.result()
+            now = time.time()
+            if now - last_print > 0.5 or n == total:
+                last_print = now
+                rate = n / max(now - started, 0.001)
+                eta = (total - n) / rate if rate else 0
+                failed = sum(1 for m, _ in results.values() if not m)
+                print(f"\r⏳ [{n}/{total}] {n * 100 / total:5.1f}%  {rate:6.1f} 张/秒  "
+                      f"剩余 {format_seconds(eta)}  失败 {failed}", end='', flush=True)
+        print()
+    except KeyboardInterrupt:
+        print(f"\n⏸️ 已中断，已完成 {len(results)} 张。再次运行同一命令即可从断点继续。")
+        # 正在处理的几张会继续完成并写入日志，排队中的直接取消
+        executor.shutdown(wait=False, cancel_futures=True)
+        metadata_index.flush()
+        preview_store.flush()
+        failures.flush()
+        return 130
+    executor.shutdown(wait=True)
+    journal.close()
+    metadata_index.flush()
+    preview_store.flush()
+    failures.flush()
+
+    # 3. 汇总报告：按任务日志汇总全部照片 (包括之前几次运行处理过的)，
+    # 每个文件走的路径写入报告文件，终端打印统计和失败列表
+    records = sorted((path, journal.done[path]) for path in sources if path in journal.done)
+    counts = {}
+    for _, rec in records:
+        method = rec['method'] or 'failed'
+        counts[method] = counts.get(method, 0) + 1
+    stamp = time.strftime("%Y%m%d_%H%M%S")
+    for n in range(1, 1000):
+        # 同一秒内多次运行时加序号，不覆盖之前的报告
+        report_path = cache / (f"._prerender_report_{stamp}.tsv" if n == 1 else f"._prerender_report_{stamp}_{n}.tsv")
+        try:
+            f = open(report_path, 'x', encoding='utf-8')
+            break
+        except FileExistsError:
+            continue
+    with f:
+        f.write("path\tmethod\treason\n")
+        for path, rec in records:
+            f.write(f"{path}\t{rec['method'] or 'failed'}\t{rec['reason']}\n")
+
+    elapsed = time.time() - started
+    print(f"✅ 本次处理 {total} 张，用时 {format_seconds(elapsed)}；全部 {len(records)} 张的结果:")
+    labels = {'pil': "PIL 直接解码", 'embedded': "RAW 内嵌缩略图", 'magick': "ImageMagick",
+              'cached': "已有缓存/重复", 'failed': "失败"}
+    for key, label in labels.items():
+        if counts.get(key):
+            print(f"   {label:<14} {counts[key]}")
+    failed = [(path, rec['reason']) for path, rec in records if rec['status'] == 'failed']
+    if failed:
+        print("❌ 失败的文件:")
+        for file_path, reason in failed:
+            print(f"   {file_path}  ({reason})")
+    print(f"🧾 逐文件报告: {report_path}")
+    return 1 if failed else 0
+
+
+# ====== 6. 命令行：前端代理 (nginx) 配置与吞吐量测试 ======
+NGINX_TEMPLATE = '''# PicShareLite 前端 nginx 配置，由 `python PicShareLiteV0.4.py nginx-conf` 生成
+# 使用前请在程序中设置 state.offload_mode = 'nginx'、state.public_port = {listen}
+worker_processes auto;
+events {{ worker_connections 1024; }}
+
+http {{
+    include       mime.types;
+    default_type  application/octet-stream;
+    sendfile      on;
+    tcp_nopush    on;
+
+    # 每个客户端同时下载原图的连接数 (对应 state.original_max_per_client)
+    limit_conn_zone $binary_remote_addr zone=psl_client:10m;
+
+    upstream picshare {{ server [::1]:{port}; }}
+
+    server {{
+        listen [::]:{listen} ipv6only=off;
+
+        location / {{
+            proxy_pass http://picshare;
+            proxy_set_header Host $host;
+            proxy_set_header X-Real-IP $remote_addr;
+            proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
+            # 告诉程序这个请求来自前端代理，可以用 X-Accel-Redirect 卸载文件传输
+            proxy_set_header X-PicShare-Offload 1;
+        }}
+
+        location /file/original/ {{
+            limit_conn psl_client {per_client};
+            proxy_pass http://picshare;
+            proxy_set_header Host $host;
+            proxy_set_header X-Real-IP $remote_addr;
+            proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
+            proxy_set_header X-PicShare-Offload 1;
+        }}
+
+        # 以下 location 只接受程序返回的内部跳转，客户端无法直接访问
+{locations}
+    }}
+}}
+'''
+
+
+def nginx_config(listen: int) -> str:
+    """按当前根目录 / 缓存目录生成 nginx 配置"""
+    blocks = []
+    for prefix, directory in offload_locations():
+        alias = directory.as_posix().rstrip('/') + '/'
+        blocks.append(f'        location {prefix} {{\n            internal;\n            alias "{alias}";\n        }}')
+    return NGINX_TEMPLATE.format(listen=listen, port=state.port, per_client=state.original_max_per_client,
+                                 locations="\n".join(blocks))
+
+
+def run_bench(args):
+    """对一个或多个 URL 并发下载，输出请求数/秒、吞吐量和延迟，用于对比直连 Flask 与经由 nginx 卸载的差别"""
+    for url in args.urls:
+        latencies, sizes, errors = [], [], 0
+        lock = threading.Lock()
+
+        def fetch(_):
+            nonlocal errors
+            t0 = time.time()
+            try:
+                with urllib.request.urlopen(url, timeout=120) as resp:
+                    n = 0
+                    while chunk := resp.read(256 * 1024):
+                        n += len(chunk)
+            except Exception:
+                with lock:
+                    errors += 1
+                return
+            with lock:
+                latencies.append(time.time() - t0)
+                sizes.append(n)
+
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(fetch, range(args.requests)))
+        elapsed = time.time() - started
+
+        latencies.sort()
+        p50 = latencies[len(latencies) // 2] * 1000 if latencies else 0
+        p95 = latencies[int(len(latencies) * 0.95)] * 1000 if latencies else 0
+        print(f"🔗 {url}")
+        print(f"   {len(latencies)} 成功 / {errors} 失败，用时 {elapsed:.2f} 秒，并发 {args.concurrency}")
+        print(f"   {len(latencies) / elapsed:8.1f} 请求/秒   {sum(sizes) / 1024 / 1024 / elapsed:8.1f} MB/秒   "
+              f"延迟 p50 {p50:.0f} ms / p95 {p95:.0f} ms")
+    return 0
+
+
+def run_path_bench(args):
+    """
+    [新增] 路径解析开销测试：按预览请求的方式 (resolve_album + safe_join) 解析根目录下的照片，
+    分别在关闭 / 开启路径缓存时计时，输出每个请求的平均耗时，并核对两种方式的解析结果一致。
+    """
+    roots = [str(Path(r).resolve()) for r in args.roots]
+    state.base_dir, state.extra_roots = roots[0], roots[1:]
+    # 按 URL 的形式收集请求：(相册名, 相对相册的 posix 路径)
+    samples = []
+    for root in state.roots:
+        for file_path, rel in PreviewGenerator.iter_sources(Path(root)):
+            samples.append((urllib.parse.quote(rel.parts[0]), urllib.parse.quote(Path(*rel.parts[1:]).as_posix())))
+            if len(samples) >= args.files:
+                break
+        if len(samples) >= args.files:
+            break
+    if not samples:
+        print("❌ 没有找到照片")
+        return 1
+
+    results = {}
+    for cached in (False, True):
+        state.path_cache = cached
+        resolver.clear()
+        resolved = []
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            resolved = []
+            for album, filename in samples:
+                _, album_dir = resolve_album(album)
+                resolved.append(safe_join(str(album_dir), filename) if album_dir else None)
+        elapsed = time.perf_counter() - started
+        results[cached] = resolved
+        per_request = elapsed / (args.rounds * len(samples)) * 1e6
+        print(f"{'开启缓存' if cached else '关闭缓存'}: {len(samples)} 张 x {args.rounds} 轮，"
+              f"平均 {per_request:.1f} µs / 请求")
+    state.path_cache = True
+    if results[False] != results[True]:
+        print("❌ 两种方式的解析结果不一致")
+        return 1
+    print("✅ 两种方式的解析结果一致")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PicShareLite IPv6 相册服务。不带参数运行时启动图形界面。")
+    sub = parser.add_subparsers(dest='command')
+    pre = sub.add_parser('prerender', help="离线预渲染预览图 (可断点续跑)")
+    pre.add_argument('roots', nargs='+', help="照片根目录，可指定多个")
+    pre.add_argument('--cache', help="预览缓存目录 (默认: 第一个根目录下的 ._preview_ipv6_opt)")
+    pre.add_argument('--workers', type=int, default=os.cpu_count() or 4, help="并发线程数")
+    pre.add_argument('--retry-failed', action='store_true', help="重新尝试之前失败的文件")
+    pre.add_argument('-v', '--verbose', action='store_true', help="输出逐张处理日志")
+
+    conf = sub.add_parser('nginx-conf', help="生成前端 nginx 配置 (X-Accel-Redirect 卸载文件传输)")
+    conf.add_argument('roots', nargs='+', help="照片根目录，顺序须与程序中一致")
+    conf.add_argument('--cache', help="预览缓存目录 (默认: 第一个根目录下的 ._preview_ipv6_opt)")
+    conf.add_argument('--listen', type=int, default=8080, help="nginx 对外监听端口")
+
+    bench = sub.add_parser('bench', help="并发下载测试，对比直连与经由代理的吞吐量")
+    bench.add_argument('urls', nargs='+', help="要测试的地址，例如同一张原图的直连地址和代理地址")
+    bench.add_argument('-n', '--requests', type=int, default=200, help="每个地址的请求总数")
+    bench.add_argument('-c', '--concurrency', type=int, default=16, help="并发数")
+
+    pbench = sub.add_parser('bench-paths', help="测试每个请求的路径解析开销 (关闭 / 开启路径缓存对比)")
+    pbench.add_argument('roots', nargs='+', help="照片根目录，可指定多个")
+    pbench.add_argument('--files', type=int, default=2000, help="参与测试的照片数上限")
+    pbench.add_argument('--rounds', type=int, default=5, help="重复轮数")
+    args = parser.parse_args(argv)
+
+    if args.command == 'prerender':
+        if not args.verbose:
+            logging.getLogger().setLevel(logging.WARNING)
+        return run_prerender(args)
+    if args.command == 'nginx-conf':
+        roots = [str(Path(r).resolve()) for r in args.roots]
+        state.base_dir, state.extra_roots = roots[0], roots[1:]
+        if args.cache:
+            state.preview_dir = str(Path(args.cache).resolve())
+        print(nginx_config(args.listen))
+        return 0
+    if args.command == 'bench':
+        return run_bench(args)
+    if args.command == 'bench-paths':
+        return run_path_bench(args)
+
     root = tk.Tk()
     ServerGUI(root)
-    root.mainloop()
\ No newline at end of file
+    root.mainloop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
\ No newline at end of file